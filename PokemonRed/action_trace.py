@@ -0,0 +1,61 @@
+from array import array
+import json
+import struct
+import zlib
+import numpy as np
+
+MAGIC = b"GBTRACE1"
+
+
+class ActionTrace:
+
+    def __init__(self, header=None, actions=None):
+        self.header = header if header is not None else {}
+        # One byte per decision instead of one Python string
+        self.actions = actions if actions is not None else array('B')
+
+    def __len__(self):
+        return len(self.actions)
+
+    def append(self, action_index):
+        self.actions.append(action_index)
+
+    def save(self, path):
+        header = json.dumps(self.header, sort_keys=True).encode()
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<II", len(header), len(self.actions)))
+            f.write(header)
+            f.write(zlib.compress(self.actions.tobytes(), 9))
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not an action trace")
+            header_size, count = struct.unpack("<II", f.read(8))
+            header = json.loads(f.read(header_size))
+            actions = array('B', zlib.decompress(f.read()))
+
+        if len(actions) != count:
+            raise ValueError(f"{path} is truncated: expected {count} actions, got {len(actions)}")
+        return ActionTrace(header, actions)
+
+
+class ReplayNetwork:
+
+    def __init__(self, actions, num_outputs):
+        self.actions = actions
+        self.num_outputs = num_outputs
+        self.position = 0
+
+    @property
+    def exhausted(self):
+        return self.position >= len(self.actions)
+
+    def activate(self, inputs):
+        # Ignore the observation and pick the recorded action
+        result = np.zeros(self.num_outputs)
+        result[self.actions[self.position]] = 1.0
+        self.position += 1
+        return result
@@ -0,0 +1,80 @@
+from pyboy_handler import PyBoyHandler
+from batched_network import BatchedNetwork
+import numpy as np
+import time
+
+
+class PlayedGenome:
+
+    def __init__(self, key):
+        # Workers get compiled networks only, the handlers need nothing of a genome but its key
+        self.key = key
+
+
+class BatchEvaluator:
+
+    def __init__(self, game_path, state_path, state, config, batch_size=1, profile_every=0, encoder=None, seed=None, budget=None, stuck=None, wait_for_action=150, trace_dir="checkpoints"):
+        self.config = config
+
+        # The first emulator prepares the start state, the others reuse it
+        first = PyBoyHandler(game_path, state_path, state=state, profile_every=profile_every, encoder=encoder, seed=seed, budget=budget, stuck=stuck, wait_for_action=wait_for_action, trace_dir=trace_dir)
+        self.handlers = [first] + [PyBoyHandler(game_path, state_path, state=first.state, profile_every=profile_every, encoder=encoder, seed=seed, budget=budget, stuck=stuck, wait_for_action=wait_for_action, trace_dir=trace_dir) for _ in range(batch_size - 1)]
+        self.profiling = profile_every > 0
+
+    def evaluate(self, jobs):
+        # jobs are (genome key, compiled network) pairs
+        if len(jobs) == 1:
+            genome_key, net = jobs[0]
+            fitness = self.handlers[0].play(net, PlayedGenome(genome_key))
+            return [(genome_key, fitness, self.handlers[0].episode_stats())]
+
+        # Step one emulator per genome in lockstep and run every network in one batched pass
+        handlers = self.handlers[:len(jobs)]
+        networks = []
+        for handler, (genome_key, net) in zip(handlers, jobs):
+            handler.begin_episode(net, PlayedGenome(genome_key))
+            networks.append(net)
+
+        batch = BatchedNetwork.create(networks)
+        observations = np.zeros((len(jobs), self.config.genome_config.num_inputs), dtype=np.float32)
+        active = list(range(len(jobs)))
+        results = []
+
+        while active:
+            finished = set()
+            for row, i in enumerate(active):
+                observation = handlers[i].observe()
+                if observation is None:
+                    finished.add(row)
+                else:
+                    observations[row] = observation
+
+            if self.profiling:
+                start = time.perf_counter()
+            outputs = batch.activate(observations[:len(active)])
+            if self.profiling:
+                # Every network shares one batched pass, split its cost evenly
+                seconds = (time.perf_counter() - start) / len(active)
+
+            for row, i in enumerate(active):
+                if row in finished:
+                    continue
+                if self.profiling:
+                    handlers[i].profiler.mark("activate", seconds)
+                if handlers[i].act(outputs[row]):
+                    finished.add(row)
+
+            if finished:
+                for row in sorted(finished):
+                    i = active[row]
+                    results.append((jobs[i][0], handlers[i].finish_episode(), handlers[i].episode_stats()))
+                keep = [row for row in range(len(active)) if row not in finished]
+                active = [active[row] for row in keep]
+                if active:
+                    batch = batch.select(keep)
+
+        return results
+
+    def stop(self):
+        for handler in self.handlers:
+            handler.end_game()
@@ -0,0 +1,125 @@
+from compiled_network import SPARSE_DENSITY
+from scipy import sparse
+import numpy as np
+
+
+class BatchedLayer:
+
+    def __init__(self, start, width, weights, bias, response, activations):
+        self.start = start
+        self.width = width
+        self.weights = weights
+        self.bias = bias
+        self.response = response
+        self.activations = activations
+
+    def select(self, rows):
+        if sparse.issparse(self.weights):
+            # Keep the diagonal blocks of the selected networks
+            weight_rows = (rows[:, None] * self.width + np.arange(self.width)).reshape(-1)
+            weight_cols = (rows[:, None] * self.start + np.arange(self.start)).reshape(-1)
+            weights = self.weights[weight_rows][:, weight_cols]
+        else:
+            weights = self.weights[rows]
+        activations = [(activation, mask[rows]) for activation, mask in self.activations]
+        return BatchedLayer(self.start, self.width, weights, self.bias[rows], self.response[rows], activations)
+
+
+class BatchedNetwork:
+
+    def __init__(self, num_inputs, layers, output_index):
+        self.num_inputs = num_inputs
+        self.layers = layers
+        self.output_index = output_index
+
+        # One row per network: inputs, padded layer slots, then a constant zero for unreachable outputs
+        size = layers[-1].start + layers[-1].width if layers else num_inputs
+        self.values = np.zeros((len(output_index), size + 1), dtype=np.float64)
+        self.rows = np.arange(len(output_index))[:, None]
+
+    def activate(self, observations):
+        values = self.values
+        values[:, :self.num_inputs] = observations
+        count = len(values)
+
+        for layer in self.layers:
+            inputs = values[:, :layer.start]
+            if sparse.issparse(layer.weights):
+                s = (layer.weights @ inputs.reshape(-1)).reshape(count, layer.width)
+            else:
+                s = np.matmul(layer.weights, inputs[:, :, None])[:, :, 0]
+            z = layer.bias + layer.response * s
+
+            # Padding slots belong to no activation group and stay at zero
+            out = values[:, layer.start:layer.start + layer.width]
+            for activation, mask in layer.activations:
+                out[mask] = activation(z[mask])
+
+        return values[self.rows, self.output_index]
+
+    def select(self, rows):
+        # Drop finished networks from the batch
+        rows = np.asarray(rows)
+        layers = [layer.select(rows) for layer in self.layers]
+        return BatchedNetwork(self.num_inputs, layers, self.output_index[rows])
+
+    @staticmethod
+    def create(networks):
+        count = len(networks)
+        num_inputs = networks[0].num_inputs
+        depth = max(len(net.layers) for net in networks)
+        widths = [max(len(net.layers[d].nodes) for net in networks if d < len(net.layers)) for d in range(depth)]
+        starts = [num_inputs]
+        for width in widths:
+            starts.append(starts[-1] + width)
+        zero = starts[-1]
+
+        # Map every network's own value positions onto the shared padded columns
+        positions = []
+        for net in networks:
+            position = np.full(len(net.values), zero, dtype=np.int64)
+            position[:num_inputs] = np.arange(num_inputs)
+            for d, layer in enumerate(net.layers):
+                position[layer.start:layer.end] = starts[d] + np.arange(layer.end - layer.start)
+            positions.append(position)
+
+        layers = []
+        for d, width in enumerate(widths):
+            start = starts[d]
+            blocks = []
+            bias = np.zeros((count, width), dtype=np.float64)
+            response = np.zeros((count, width), dtype=np.float64)
+            masks = {}
+            for i, net in enumerate(networks):
+                if d >= len(net.layers):
+                    continue
+                layer = net.layers[d]
+                size = layer.end - layer.start
+                coo = sparse.coo_matrix(layer.weights)
+                blocks.append((i, coo.row, positions[i][coo.col], coo.data))
+                bias[i, :size] = layer.bias
+                response[i, :size] = layer.response
+                for activation, index in layer.activations:
+                    mask = masks.setdefault(activation, np.zeros((count, width), dtype=bool))
+                    if index is None:
+                        mask[i, :size] = True
+                    else:
+                        mask[i, index] = True
+
+            # Padded dense tensor when it is dense enough, block-diagonal CSR otherwise
+            nnz = sum(len(data) for _, _, _, data in blocks)
+            if nnz >= SPARSE_DENSITY * count * width * start:
+                weights = np.zeros((count, width, start), dtype=np.float64)
+                for i, rows, cols, data in blocks:
+                    weights[i, rows, cols] = data
+            else:
+                rows = np.concatenate([i * width + rows for i, rows, _, _ in blocks])
+                cols = np.concatenate([i * start + cols for i, _, cols, _ in blocks])
+                data = np.concatenate([data for _, _, _, data in blocks])
+                weights = sparse.csr_matrix((data, (rows, cols)), shape=(count * width, count * start))
+
+            layers.append(BatchedLayer(start, width, weights, bias, response, list(masks.items())))
+
+        output_index = np.array([position[net.output_index] for net, position in zip(networks, positions)])
+
+        return BatchedNetwork(num_inputs, layers, output_index)
@@ -0,0 +1,140 @@
+from neat.graphs import feed_forward_layers
+from scipy import sparse
+import numpy as np
+
+# Layers whose weight matrix is less dense than this are stored as CSR
+SPARSE_DENSITY = 0.2
+
+
+def relu_activation(z):
+    return np.maximum(z, 0.0)
+
+
+def sigmoid_activation(z):
+    z = np.clip(5.0 * z, -60.0, 60.0)
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+def tanh_activation(z):
+    z = np.clip(2.5 * z, -60.0, 60.0)
+    return np.tanh(z)
+
+
+def identity_activation(z):
+    return z
+
+
+def clamped_activation(z):
+    return np.clip(z, -1.0, 1.0)
+
+
+# Same formulas as neat.activations, applied to whole arrays
+ACTIVATIONS = {
+    'relu': relu_activation,
+    'sigmoid': sigmoid_activation,
+    'tanh': tanh_activation,
+    'identity': identity_activation,
+    'clamped': clamped_activation,
+}
+
+
+class Layer:
+
+    def __init__(self, start, nodes, weights, bias, response, activations):
+        self.start = start
+        self.end = start + len(nodes)
+        self.nodes = nodes
+        self.weights = weights
+        self.bias = bias
+        self.response = response
+        self.activations = activations
+
+
+class CompiledNetwork:
+
+    def __init__(self, num_inputs, layers, output_index):
+        self.num_inputs = num_inputs
+        self.layers = layers
+        self.output_index = output_index
+
+        # Inputs, then every evaluated node in layer order, then a constant zero for unreachable outputs
+        size = layers[-1].end if layers else num_inputs
+        self.values = np.zeros(size + 1, dtype=np.float64)
+
+    def activate(self, inputs):
+        if len(inputs) != self.num_inputs:
+            raise RuntimeError("Expected {0:n} inputs, got {1:n}".format(self.num_inputs, len(inputs)))
+
+        values = self.values
+        values[:self.num_inputs] = inputs
+
+        for layer in self.layers:
+            s = layer.weights @ values[:layer.start]
+            z = layer.bias + layer.response * s
+            for activation, index in layer.activations:
+                if index is None:
+                    values[layer.start:layer.end] = activation(z)
+                else:
+                    values[layer.start + index] = activation(z[index])
+
+        return values[self.output_index]
+
+    @staticmethod
+    def create(genome, config):
+        genome_config = config.genome_config
+        input_keys = genome_config.input_keys
+        output_keys = genome_config.output_keys
+
+        # Expressed connections as (in, out, weight) arrays, an ArrayGenome keeps them that way already
+        if hasattr(genome, "expressed_connections"):
+            sources, targets, weights = genome.expressed_connections()
+        else:
+            expressed = [cg for cg in genome.connections.values() if cg.enabled]
+            sources = np.fromiter((cg.key[0] for cg in expressed), dtype=np.int64, count=len(expressed))
+            targets = np.fromiter((cg.key[1] for cg in expressed), dtype=np.int64, count=len(expressed))
+            weights = np.fromiter((cg.weight for cg in expressed), dtype=np.float64, count=len(expressed))
+        connections = list(zip(sources.tolist(), targets.tolist()))
+
+        # Input -1 reads column 0, -2 column 1 and so on, a node gets its column once its layer is placed
+        position = np.full(max(genome.nodes, default=-1) + 1, -1, dtype=np.int64)
+        start = len(input_keys)
+        layers = []
+        # A set of inputs gives the same layers, neat only tests membership and a list makes that linear
+        for layer_nodes in feed_forward_layers(set(input_keys), output_keys, connections):
+            nodes = sorted(layer_nodes)
+            feeding = np.isin(targets, nodes)
+            inodes = sources[feeding]
+            rows = np.searchsorted(nodes, targets[feeding])
+            cols = np.where(inodes < 0, -inodes - 1, position[np.maximum(inodes, 0)])
+
+            # Duplicate entries are summed, matching the sum aggregation
+            matrix = sparse.csr_matrix((weights[feeding], (rows, cols)), shape=(len(nodes), start), dtype=np.float64)
+            if matrix.nnz >= SPARSE_DENSITY * len(nodes) * start:
+                matrix = matrix.toarray()
+
+            node_genes = [genome.nodes[node] for node in nodes]
+            for ng in node_genes:
+                if ng.aggregation != 'sum':
+                    raise ValueError(f"Unsupported aggregation for compiled network: {ng.aggregation}")
+
+            groups = {}
+            for i, ng in enumerate(node_genes):
+                if ng.activation not in ACTIVATIONS:
+                    raise ValueError(f"Unsupported activation for compiled network: {ng.activation}")
+                groups.setdefault(ng.activation, []).append(i)
+            if len(groups) == 1:
+                activations = [(ACTIVATIONS[name], None) for name in groups]
+            else:
+                activations = [(ACTIVATIONS[name], np.array(index)) for name, index in groups.items()]
+
+            bias = np.array([ng.bias for ng in node_genes], dtype=np.float64)
+            response = np.array([ng.response for ng in node_genes], dtype=np.float64)
+            layers.append(Layer(start, nodes, matrix, bias, response, activations))
+
+            position[nodes] = start + np.arange(len(nodes))
+            start += len(nodes)
+
+        # Outputs that are never evaluated read the trailing zero
+        output_index = np.array([position[key] if position[key] >= 0 else start for key in output_keys])
+
+        return CompiledNetwork(len(input_keys), layers, output_index)
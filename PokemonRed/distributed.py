@@ -0,0 +1,329 @@
+from multiprocessing.connection import Listener, Client, wait
+from collections import deque
+from worker_pool import WorkerPool
+from episode_budget import EpisodeBudget
+from fast_species import FastSpeciesSet
+from array_genome import ArrayGenome
+import hashlib
+import neat
+import os
+import pickle
+import sys
+import threading
+import time
+
+# Every message is unpickled, so the farm only runs with a secret key shared by the coordinator and its nodes
+AUTHKEY_VARIABLE = "NEAT_AUTHKEY"
+HEARTBEAT_EVERY = 2.0
+HEARTBEAT_TIMEOUT = 10.0
+
+
+def farm_authkey(authkey=None):
+    authkey = authkey if authkey is not None else os.environ.get(AUTHKEY_VARIABLE, "").encode()
+    if not authkey:
+        raise RuntimeError(f"Set {AUTHKEY_VARIABLE} to a secret shared by the coordinator and every worker daemon")
+    return authkey
+
+
+class WorkerDaemon:
+
+    def __init__(self, port, num_workers=None, cache_dir="ROM/cache", authkey=None, host="127.0.0.1"):
+        # Only local coordinators can connect unless another interface is given, e.g. "0.0.0.0" on a trusted network
+        self.host = host
+        self.port = port
+        self.num_workers = num_workers or os.cpu_count()
+        self.cache_dir = cache_dir
+        self.authkey = farm_authkey(authkey)
+        self.pool = None
+        self.setup_key = None
+        self.send_lock = threading.Lock()
+
+    def serve(self):
+        # One coordinator at a time, the emulators stay up between runs with the same setup
+        listener = Listener((self.host, self.port), authkey=self.authkey)
+        print(f"Worker daemon on {self.host}:{self.port} with {self.num_workers} processes")
+        try:
+            while True:
+                conn = listener.accept()
+                print(f"Coordinator connected from {listener.last_accepted}")
+                try:
+                    self.session(conn)
+                except (EOFError, OSError) as e:
+                    # Tasks of a lost coordinator may still be queued, so the pool restarts clean
+                    print(f"Coordinator lost: {e!r}")
+                    self.stop_pool()
+                finally:
+                    conn.close()
+        finally:
+            listener.close()
+            self.stop_pool()
+
+    def send(self, conn, message):
+        with self.send_lock:
+            conn.send(message)
+
+    def cached_path(self, file_hash, suffix):
+        return os.path.join(self.cache_dir, f"{file_hash}{suffix}") if file_hash is not None else None
+
+    def session(self, conn):
+        self.send(conn, ("hello", self.num_workers))
+        running = threading.Event()
+        running.set()
+        threads = [threading.Thread(target=self.heartbeat, args=(conn, running), daemon=True), threading.Thread(target=self.forward_results, args=(conn, running), daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                message = conn.recv()
+                kind = message[0]
+                if kind == "setup":
+                    self.setup(conn, *message[1:])
+                elif kind == "tasks":
+                    self.pool.submit(message[1])
+                elif kind == "reset":
+                    self.budget.cutoff.value = 0
+                elif kind == "cutoff":
+                    self.budget.cutoff.value = 1
+                elif kind == "stop":
+                    break
+        finally:
+            running.clear()
+            for thread in threads:
+                thread.join()
+
+    def setup(self, conn, rom_hash, state_hash, config_text, options, limits):
+        # The ROM and start state are kept on disk by hash, so they cross the network once per node
+        missing = [(file_hash, suffix) for file_hash, suffix in ((rom_hash, ".gb"), (state_hash, ".state")) if file_hash is not None and not os.path.exists(self.cached_path(file_hash, suffix))]
+        self.send(conn, ("need", [file_hash for file_hash, _ in missing]))
+        for file_hash, suffix in missing:
+            kind, received_hash, data = conn.recv()
+            if hashlib.sha1(data).hexdigest() != received_hash:
+                raise ValueError(f"Corrupt transfer of {received_hash}")
+            self.write(self.cached_path(received_hash, suffix), data)
+
+        config_hash = hashlib.sha1(config_text.encode()).hexdigest()
+        config_path = self.cached_path(config_hash, ".txt")
+        if not os.path.exists(config_path):
+            self.write(config_path, config_text.encode())
+
+        # A new coordinator with the same setup reuses the running emulators
+        setup_key = (rom_hash, state_hash, config_hash, hashlib.sha1(pickle.dumps(sorted(options.items()))).hexdigest(), limits)
+        if self.pool is None or self.setup_key != setup_key:
+            self.stop_pool()
+            config = neat.Config(ArrayGenome.select(config_path), neat.DefaultReproduction, FastSpeciesSet.select(config_path), neat.DefaultStagnation, config_path)
+            # Quorum cutoffs come from the coordinator, only the step and time limits are local
+            self.budget = EpisodeBudget(*limits)
+            self.pool = WorkerPool(self.cached_path(rom_hash, ".gb"), self.cached_path(state_hash, ".state"), config, self.num_workers, budget=self.budget, **options)
+            self.pool.start()
+            self.setup_key = setup_key
+        self.send(conn, ("ready",))
+
+    def write(self, path, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def heartbeat(self, conn, running):
+        while running.is_set():
+            try:
+                self.send(conn, ("heartbeat",))
+            except (OSError, ValueError):
+                return
+            time.sleep(HEARTBEAT_EVERY)
+
+    def forward_results(self, conn, running):
+        # Stream every finished episode back as soon as a local worker reports it
+        while running.is_set():
+            if self.pool is None:
+                time.sleep(0.1)
+                continue
+            try:
+                results = self.pool.collect(timeout=0.5)
+            except RuntimeError as e:
+                # Without heartbeats the coordinator gives up on this node and plays its genomes elsewhere
+                print(f"Local workers failed: {e!r}")
+                running.clear()
+                return
+            for result in results:
+                try:
+                    self.send(conn, ("result",) + result)
+                except (OSError, ValueError):
+                    return
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+            self.setup_key = None
+
+
+class RemoteWorker:
+
+    def __init__(self, address, conn, processes):
+        self.address = address
+        self.conn = conn
+        self.processes = processes
+        self.last_seen = time.monotonic()
+        # Batches sent to this node and the genomes of each that have not come back yet
+        self.outstanding = []
+
+
+class DistributedPool:
+
+    def __init__(self, addresses, game_path, state_path, config_file, batch_size=1, budget=None, authkey=None, **options):
+        # Same interface as WorkerPool, options are passed on to the WorkerPool of every node
+        self.addresses = addresses
+        self.game_path = game_path
+        self.state_path = state_path
+        self.config_file = config_file
+        self.batch_size = batch_size
+        self.budget = budget
+        self.authkey = farm_authkey(authkey)
+        self.options = dict(options, batch_size=batch_size)
+        self.workers = []
+        self.stats = {}
+
+    def start(self):
+        with open(self.game_path, "rb") as f:
+            rom = f.read()
+        state = None
+        if self.state_path is not None:
+            with open(self.state_path, "rb") as f:
+                state = f.read()
+        with open(self.config_file) as f:
+            config_text = f.read()
+        rom_hash = hashlib.sha1(rom).hexdigest()
+        state_hash = hashlib.sha1(state).hexdigest() if state is not None else None
+        files = {rom_hash: rom, state_hash: state}
+        limits = (self.budget.max_steps, self.budget.max_seconds) if self.budget is not None else (0, 0.0)
+
+        for address in self.addresses:
+            host, port = address.rsplit(":", 1)
+            try:
+                conn = Client((host, int(port)), authkey=self.authkey)
+            except OSError as e:
+                print(f"Worker {address} unreachable: {e!r}")
+                continue
+            kind, processes = self.receive(conn)
+            conn.send(("setup", rom_hash, state_hash, config_text, self.options, limits))
+            kind, needed = self.receive(conn)
+            for file_hash in needed:
+                conn.send(("file", file_hash, files[file_hash]))
+            self.receive(conn)
+            self.workers.append(RemoteWorker(address, conn, processes))
+            print(f"Worker {address} ready with {processes} processes, sent {len(needed)} files")
+
+        if not self.workers:
+            raise RuntimeError("No worker daemon reachable")
+
+    def receive(self, conn):
+        # Skip heartbeats while waiting for a reply during setup
+        while True:
+            message = conn.recv()
+            if message[0] != "heartbeat":
+                return message
+
+    def evaluate(self, genomes, expected_steps=None):
+        # Longest expected episodes go first so they never start last and hold up the generation
+        if expected_steps:
+            genomes = sorted(genomes, key=lambda item: -expected_steps.get(item[0], 0))
+
+        quorum = len(genomes)
+        if self.budget is not None:
+            quorum = self.budget.quorum_size(len(genomes))
+
+        total_processes = sum(worker.processes for worker in self.workers)
+        size = max(1, min(self.batch_size, -(-len(genomes) // total_processes)))
+        pending = deque(list(genomes[i:i + size]) for i in range(0, len(genomes), size))
+
+        for worker in list(self.workers):
+            self.send(worker, ("reset",), pending)
+
+        fitnesses = {}
+        self.stats = {}
+        while len(fitnesses) < len(genomes):
+            self.dispatch(pending)
+            if not self.workers:
+                raise RuntimeError("Every worker daemon was lost")
+
+            for conn in wait([worker.conn for worker in self.workers], timeout=1.0):
+                worker = next(w for w in self.workers if w.conn is conn)
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    self.lose(worker, pending, "connection closed")
+                    continue
+                worker.last_seen = time.monotonic()
+                if message[0] == "result":
+                    _, genome_key, fitness, stats = message
+                    if not self.complete(worker, genome_key) or genome_key in fitnesses:
+                        continue
+                    fitnesses[genome_key] = fitness
+                    self.stats[genome_key] = stats
+                    if len(fitnesses) == quorum and quorum < len(genomes):
+                        for other in list(self.workers):
+                            self.send(other, ("cutoff",), pending)
+
+            now = time.monotonic()
+            for worker in list(self.workers):
+                if now - worker.last_seen > HEARTBEAT_TIMEOUT:
+                    self.lose(worker, pending, "no heartbeat")
+
+        return fitnesses
+
+    def dispatch(self, pending):
+        # Two batches per process keep every node busy while the next results travel back
+        for worker in list(self.workers):
+            while pending and len(worker.outstanding) < 2 * worker.processes:
+                batch = pending.popleft()
+                worker.outstanding.append((batch, {genome_key for genome_key, _ in batch}))
+                self.send(worker, ("tasks", batch), pending)
+                if worker not in self.workers:
+                    break
+
+    def complete(self, worker, genome_key):
+        for i, (batch, waiting) in enumerate(worker.outstanding):
+            if genome_key in waiting:
+                waiting.discard(genome_key)
+                if not waiting:
+                    del worker.outstanding[i]
+                return True
+        return False
+
+    def send(self, worker, message, pending=None):
+        try:
+            worker.conn.send(message)
+        except (OSError, ValueError):
+            self.lose(worker, pending, "send failed")
+
+    def lose(self, worker, pending, reason):
+        # Unfinished genomes of a lost node go back to the front of the queue for the others
+        if worker not in self.workers:
+            return
+        self.workers.remove(worker)
+        worker.conn.close()
+        lost = 0
+        for batch, waiting in reversed(worker.outstanding):
+            redo = [job for job in batch if job[0] in waiting]
+            lost += len(redo)
+            if pending is not None and redo:
+                pending.appendleft(redo)
+        print(f"Worker {worker.address} lost ({reason}), re-dispatching {lost} genomes")
+
+    def stop(self):
+        for worker in self.workers:
+            try:
+                worker.conn.send(("stop",))
+                worker.conn.close()
+            except OSError:
+                pass
+        self.workers = []
+
+
+if __name__ == "__main__":
+    # NEAT_AUTHKEY=<secret> python distributed.py <port> [processes] [bind host], start one per node and pass host:port
+    # of each to ModelHandler(workers=...). The bind host defaults to 127.0.0.1, use the node's address to accept remote coordinators
+    WorkerDaemon(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] else None, host=sys.argv[3] if len(sys.argv) > 3 else "127.0.0.1").serve()
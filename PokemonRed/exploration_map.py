@@ -0,0 +1,58 @@
+from array import array
+import numpy as np
+
+MAP_SIZE = 256 * 256
+
+
+class ExplorationMap:
+
+    def __init__(self, num_maps=256):
+        self.num_maps = num_maps
+        # One visit counter per (map, y, x), saturating at 255, indexed straight by the RAM bytes
+        self.counts = bytearray(num_maps * MAP_SIZE)
+        self.visits = np.frombuffer(self.counts, dtype=np.uint8).reshape(num_maps, 256, 256)
+        # Flat indices in first-visit order, so a reset only clears what was touched
+        self.visited = array('I')
+
+    def __len__(self):
+        return len(self.visited)
+
+    @staticmethod
+    def index(x_pos, y_pos, map_n):
+        return (map_n << 16) | (y_pos << 8) | x_pos
+
+    def visit(self, index):
+        # Returns True the first time a coordinate is seen
+        count = self.counts[index]
+        if count < 255:
+            self.counts[index] = count + 1
+        if count == 0:
+            self.visited.append(index)
+            return True
+        return False
+
+    def add(self, visited):
+        # Merge flat indices seen elsewhere, e.g. by the other genomes of a generation
+        indices = np.unique(np.frombuffer(visited, dtype=np.uint32))
+        flat = self.visits.reshape(-1)
+        counts = flat[indices]
+        new = indices[counts == 0]
+        flat[indices] = np.minimum(counts.astype(np.uint16) + 1, 255)
+        self.visited.extend(new.tolist())
+        return len(new)
+
+    def reset(self):
+        if self.visited:
+            self.visits.reshape(-1)[np.frombuffer(self.visited, dtype=np.uint32)] = 0
+            del self.visited[:]
+
+    def maps(self):
+        return np.unique(np.frombuffer(self.visited, dtype=np.uint32) >> 16)
+
+    def heatmap(self, map_n):
+        return self.visits[map_n]
+
+    def save_heatmaps(self, path):
+        # Only the maps that were entered, as (maps, 256, 256) counts
+        maps = self.maps()
+        np.savez_compressed(path, maps=maps, visits=self.visits[maps])
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+import configparser
+import hashlib
+import json
+import numpy as np
+import os
+
+
+class FitnessCache:
+
+    def __init__(self, environment, max_entries=10000):
+        # environment is the hash of everything besides the genome that decides a fitness
+        self.environment = environment
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_config(config_file, environment):
+        # None when the config has no [FitnessCache] section or marks the environment as stochastic
+        parser = configparser.ConfigParser()
+        parser.read(config_file)
+        if not parser.has_section("FitnessCache"):
+            return None
+        section = parser["FitnessCache"]
+        if section.getboolean("stochastic", fallback=False):
+            return None
+        return FitnessCache(environment, section.getint("max_entries", fallback=10000))
+
+    @staticmethod
+    def persistent(config_file):
+        parser = configparser.ConfigParser()
+        parser.read(config_file)
+        return parser.getboolean("FitnessCache", "persist", fallback=False)
+
+    @staticmethod
+    def environment_hash(*paths, extra=b""):
+        # ROM, start state and NEAT config, a missing path (e.g. no state file) hashes as empty
+        h = hashlib.sha1()
+        for path in paths:
+            if path is not None and os.path.exists(path):
+                with open(path, "rb") as f:
+                    h.update(hashlib.sha1(f.read()).digest())
+            else:
+                h.update(b"\0")
+        h.update(extra)
+        return h.hexdigest()
+
+    def key(self, genome):
+        # Structural hash, floats go through repr so any change in a weight or bias changes the key
+        nodes = genome.nodes
+        h = hashlib.sha1(self.environment.encode())
+        h.update(repr([(k, nodes[k].bias, nodes[k].response, nodes[k].activation, nodes[k].aggregation) for k in sorted(nodes)]).encode())
+        if hasattr(genome, "expressed_connections"):
+            # An ArrayGenome hashes the raw arrays in key order, the genome type is part of the config and so of the environment
+            order = np.lexsort((genome.targets, genome.sources))
+            for array in (genome.sources, genome.targets, genome.weights, genome.enabled):
+                h.update(array[order].tobytes())
+        else:
+            connections = genome.connections
+            h.update(repr([(k, connections[k].weight, connections[k].enabled) for k in sorted(connections)]).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def behaviour(self, key):
+        # Behaviour descriptor of the episode the fitness came from, None if it was cached without one
+        entry = self.entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def put(self, key, fitness, behaviour=None):
+        self.entries[key] = [fitness, behaviour]
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self, path):
+        # Oldest first so the eviction order survives a resume
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"environment": self.environment, "entries": list(self.entries.items())}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        # Entries of another ROM, state or config are ignored
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            data = json.load(f)
+        if data["environment"] != self.environment:
+            return 0
+        for key, entry in data["entries"]:
+            # Caches saved before behaviours were stored hold the bare fitness
+            self.put(key, *(entry if isinstance(entry, list) else [entry]))
+        return len(self.entries)
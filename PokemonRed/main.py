@@ -1,5 +1,5 @@
 from model_handler import ModelHandler
 
 if __name__ == "__main__":
-    model_handler = ModelHandler()
+    model_handler = ModelHandler(checkpoint="latest")
     model_handler.run()
@@ -20,3 +20,6 @@ MONEY_ADDRESS_3 = 0xD349
 
 BATTLE_FLAG_ADDRESS = 0xD057
 
+TILE_MAP_ADDRESS = 0xC3A0 # wTileMap, the tiles on screen as 18 rows of 20
+TILE_MAP_ROWS, TILE_MAP_COLS = 18, 20
+
@@ -1,10 +1,28 @@
+from worker_pool import WorkerPool
+from distributed import DistributedPool
+from compact_checkpointer import CompactCheckpointer
+from telemetry import TelemetryReporter
 from pyboy_handler import PyBoyHandler
-from multiprocessing import Process, Queue
+from compiled_network import CompiledNetwork
+from emulator_settings import EmulatorSettings
+from profiler import StepProfiler
+from fast_species import FastSpeciesSet
+from array_genome import ArrayGenome
+from fitness_cache import FitnessCache
+from episode_budget import EpisodeBudget
+from stuck_detector import StuckDetector
+from novelty_archive import NoveltyArchive
+from collections import Counter
+from exploration_map import ExplorationMap
+from observation_encoder import ObservationEncoder
+import numpy as np
 import neat
+import time
+import os
 
 class ModelHandler:
     
-    def __init__(self, game_path="ROM/PokemonRed.gb", state_path="ROM/states/has_pokedex.state", config_file="config-neat.txt", generations=20):
+    def __init__(self, game_path="ROM/PokemonRed.gb", state_path="ROM/states/has_pokedex.state", config_file="config-neat.txt", generations=20, batch_size=1, profile_every=0, encoder="pca", fitness_cache_path="fitness-cache.json", workers=None, checkpoint=None, checkpoint_dir="checkpoints", telemetry_dir="telemetry"):
         self.list_of_pb = []
         self.generations = generations
         self.population_size = 3
@@ -12,51 +30,261 @@ class ModelHandler:
         self.state_path = state_path
         self.config_file = config_file
         self.current_generation = 0
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        # Steps between profiled samples in every worker, 0 disables profiling
+        self.profile_every = profile_every
+        self.pool = None
+        # Compact checkpoints of every generation, resumed with checkpoint="latest" or a generation number
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpointer = None
+        self.resumed_generation = None
+        # Per-generation JSONL and Prometheus textfile output, see TelemetryReporter
+        self.telemetry_dir = telemetry_dir
+        self.telemetry = None
+        # host:port of worker daemons (see distributed.py), None evaluates on the local cores
+        self.workers = workers
+        # Fitness of already played genomes, enabled by a [FitnessCache] section in the config
+        self.fitness_cache = None
+        self.fitness_cache_path = fitness_cache_path
+        self.persist_fitness_cache = False
+        # Step, time and quorum limits of every episode, enabled by an [EpisodeBudget] section in the config
+        self.budget = None
+        # Ends or penalises episodes stuck repeating the same state, enabled by a [StuckDetector] section in the config
+        self.stuck = None
+        # Behaviours of the whole run indexed for novelty search, enabled by a [NoveltyArchive] section in the config
+        self.novelty = None
+        self.novelty_path = os.path.join(checkpoint_dir, "novelty-archive.npz")
+        # Decisions taken by every genome of the last generation, to start the longest episodes first
+        self.episode_steps = {}
+        # Fitness of every genome of the last generation, inherited by children the quorum skips
+        self.fitnesses = {}
+        # Behaviour descriptor of every genome of the last generation, for genomes whose fitness is cached
+        self.behaviours = {}
+        self.population = None
+        # Kind of encoder used when num_inputs is smaller than the raw observation, pca or random
+        self.encoder_kind = encoder
+        self.encoder = None
+        # Every tile reached by any genome over the whole run
+        self.coverage = ExplorationMap()
 
-    def create_handler(self, net, genome, queue):
-        handler = PyBoyHandler(self.game_path, self.state_path, net, genome)
-        fitness = handler.start_game()
-        queue.put((genome.key, fitness))
-    
     def eval_genomes(self, genomes, config):
         
         self.current_generation += 1
-        
-        processes = []
-        queue = Queue()
-        
+        start = time.perf_counter()
+
         for _, genome in genomes:
             genome.fitness = 0  # start with fitness level of 0
-            net = neat.nn.FeedForwardNetwork.create(genome, config)
-            p = Process(target=self.create_handler, args=(net, genome, queue))
-            processes.append(p)
-            p.start()
-            
-        for p in processes:
-            p.join()
-            
-        while not queue.empty():
-            genome_id, fitness = queue.get()
-            for _, genome in genomes:
-                if genome.key == genome_id:
+
+        # Genomes that were already played in the same environment, e.g. elites, keep their fitness
+        keys = {}
+        if self.fitness_cache is not None:
+            misses = []
+            for genome_id, genome in genomes:
+                keys[genome_id] = self.fitness_cache.key(genome)
+                fitness = self.fitness_cache.get(keys[genome_id])
+                if fitness is None:
+                    misses.append((genome_id, genome))
+                else:
                     genome.fitness = fitness
-                    break
+                    self.behaviours[genome_id] = self.fitness_cache.behaviour(keys[genome_id])
+        else:
+            misses = genomes
+
+        fitnesses = self.pool.evaluate(misses, self.expected_steps(misses))
+
+        unplayed = set()
+        for genome_id, genome in misses:
+            # A genome the quorum skipped before its first step has no fitness of its own and is not cached
+            if self.pool.stats[genome_id]["truncated"] == "unplayed":
+                genome.fitness = self.inherit(self.fitnesses, genome_id, 0.0)
+                unplayed.add(genome_id)
+                continue
+            genome.fitness = fitnesses[genome_id]
+            # Episodes cut off by the clock or the quorum could score differently next time
+            if self.fitness_cache is not None and (self.budget is None or self.budget.deterministic(self.pool.stats[genome_id]["truncated"])):
+                self.fitness_cache.put(keys[genome_id], genome.fitness, self.pool.stats[genome_id].get("behaviour"))
+
+        # Cached genomes keep the episode length they had when they were played, skipped ones are only known by it
+        self.episode_steps = {genome_id: self.pool.stats[genome_id]["steps"] if genome_id in self.pool.stats and genome_id not in unplayed else self.episode_steps.get(genome_id, 0) for genome_id, _ in genomes if genome_id not in unplayed or genome_id in self.episode_steps}
+        self.fitnesses = {genome_id: genome.fitness for genome_id, genome in genomes}
+        # Fitness is cached without novelty, it changes as the archive grows. The behaviour is cached with it
+        if self.novelty is not None:
+            self.add_novelty(genomes)
+        if self.budget is not None:
+            self.report_budget(len(misses) - len(unplayed))
+        if self.stuck is not None:
+            self.report_stuck(len(misses))
+        if self.telemetry is not None:
+            self.telemetry.record_evaluation(self.pool.stats, time.perf_counter() - start, len(genomes) - len(misses))
+
+        if self.fitness_cache is not None:
+            print(f"Fitness cache: {len(genomes) - len(misses)} of {len(genomes)} genomes reused, {len(self.fitness_cache.entries)} cached")
+            if self.persist_fitness_cache:
+                self.fitness_cache.save(self.fitness_cache_path)
+
+        self.report_coverage()
+        if self.profile_every:
+            self.report_profile()
+
+    def report_coverage(self):
+        visited = b"".join(stats["visited"] for stats in self.pool.stats.values())
+        tiles = np.unique(np.frombuffer(visited, dtype=np.uint32))
+        new_tiles = self.coverage.add(tiles.tobytes())
+        print(f"Coverage: {len(tiles)} tiles this generation, {new_tiles} new, {len(self.coverage)} in {len(self.coverage.maps())} maps overall")
+
+    def report_profile(self):
+        profile = StepProfiler.merge({key: stats["profile"] for key, stats in self.pool.stats.items()})
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in sorted(profile["stages"].items(), key=lambda item: -item[1]))
+        print(f"Step latency p50 {profile['p50'] * 1e3:.2f} ms, p99 {profile['p99'] * 1e3:.2f} ms over {profile['samples']} samples, {100 * profile['emulation_share']:.0f}% in emulation ({stages})")
+        print("Slowest genomes: " + ", ".join(f"{key} ({seconds * 1e3:.2f} ms/step)" for key, seconds in profile["slowest"]))
+
+    def create_encoder(self, config):
+        # Fit or load the encoder once here so the workers never fit it in parallel
+        handler = PyBoyHandler(self.game_path, self.state_path, save_traces=False)
+        try:
+            return ObservationEncoder.for_inputs(config.genome_config.num_inputs, handler, self.encoder_kind)
+        finally:
+            handler.end_game()
 
-    def run(self):
-        config = neat.config.Config(neat.DefaultGenome, neat.DefaultReproduction,
-                         neat.DefaultSpeciesSet, neat.DefaultStagnation,
+    def expected_steps(self, genomes):
+        # Unknown episode lengths default to the longest seen so those genomes start early
+        longest = max(self.episode_steps.values(), default=0)
+        return {genome_id: self.inherit(self.episode_steps, genome_id, longest) for genome_id, _ in genomes}
+
+    def inherit(self, known, genome_id, default):
+        # A genome's own value from the last generation, else the mean of its parents', else the default
+        if genome_id in known:
+            return known[genome_id]
+        ancestors = self.population.reproduction.ancestors if self.population is not None else {}
+        parents = [known[key] for key in ancestors.get(genome_id, ()) if key in known]
+        return sum(parents) / len(parents) if parents else default
+
+    def add_novelty(self, genomes):
+        self.behaviours = {genome_id: self.pool.stats[genome_id]["behaviour"] if genome_id in self.pool.stats else self.behaviours.get(genome_id) for genome_id, _ in genomes}
+        # Cached genomes carry the behaviour stored with their fitness, only entries of an older cache file have none
+        known = [(genome_id, genome) for genome_id, genome in genomes if self.behaviours[genome_id] is not None]
+        if not known:
+            return
+        behaviours = np.array([self.behaviours[genome_id] for genome_id, _ in known], dtype=np.float64)
+        novelty = self.novelty.scores(behaviours)
+        for (_, genome), score in zip(known, novelty.tolist()):
+            genome.fitness += self.novelty.weight * score
+        added = self.novelty.add(behaviours, novelty, self.population.generation)
+        self.novelty.save(self.novelty_path)
+        print(f"Novelty: mean {novelty.mean():.2f}, max {novelty.max():.2f}, {added} behaviours archived, {len(self.novelty)} in the archive")
+
+    def report_budget(self, played):
+        truncated = Counter(stats["truncated"] for stats in self.pool.stats.values() if stats["truncated"] is not None)
+        skipped = truncated.pop("unplayed", 0)
+        if truncated:
+            limits = ", ".join(f"{count} by {limit}" for limit, count in truncated.most_common())
+            print(f"Episode budget: {sum(truncated.values())} of {played} episodes cut off ({limits})")
+        if skipped:
+            print(f"Episode budget: {skipped} queued genomes skipped by the quorum, they inherit their parents' fitness")
+
+    def report_stuck(self, played):
+        stuck = sum(1 for stats in self.pool.stats.values() if stats["stuck"])
+        if stuck:
+            print(f"Stuck detector: {stuck} of {played} episodes {'ended early' if self.stuck.terminate else 'penalised'}")
+
+    def restore_population(self, config):
+        # A compact checkpoint by generation or "latest", else an old neat-checkpoint-N pickle
+        if self.checkpoint is None:
+            return neat.Population(config)
+        if self.checkpoint == "latest" or os.path.exists(os.path.join(self.checkpoint_dir, f"checkpoint-{self.checkpoint:06d}.json")):
+            p = CompactCheckpointer.restore(config, self.checkpoint_dir, self.checkpoint)
+            if p is None:
+                print(f"No checkpoint in {self.checkpoint_dir}, starting a new population")
+                return neat.Population(config)
+            print(f"Resuming from checkpoint: generation {p.generation} in {self.checkpoint_dir}")
+            self.resumed_generation = p.generation
+            return p
+
+        print(f"Resuming from checkpoint: {self.checkpoint}")
+        p = neat.Checkpointer.restore_checkpoint('neat-checkpoint-' + str(self.checkpoint))
+        CompactCheckpointer.continue_indexers(p)
+        return p
+
+    def create_fitness_cache(self, config_file, extra=b""):
+        # Cached fitnesses are only valid for the same ROM, start state and config
+        environment = FitnessCache.environment_hash(self.game_path, self.state_path, config_file, extra=extra)
+        self.fitness_cache = FitnessCache.from_config(config_file, environment)
+        if self.fitness_cache is None:
+            return
+        self.persist_fitness_cache = FitnessCache.persistent(config_file)
+        if self.persist_fitness_cache:
+            loaded = self.fitness_cache.load(self.fitness_cache_path)
+            if loaded:
+                print(f"Loaded {loaded} cached fitnesses from {self.fitness_cache_path}")
+
+    def create_novelty_archive(self):
+        # A resumed run continues the archive as it was at its checkpoint, a new run starts an empty one
+        self.novelty = NoveltyArchive.from_config(self.config_file)
+        if self.novelty is not None and self.resumed_generation is not None:
+            loaded = self.novelty.load(self.novelty_path, self.resumed_generation)
+            print(f"Loaded {loaded} archived behaviours from {self.novelty_path}")
+
+    def run(self, pool=None, reporters=()):
+        config = neat.config.Config(ArrayGenome.select(self.config_file), neat.DefaultReproduction,
+                         FastSpeciesSet.select(self.config_file), neat.DefaultStagnation,
                          self.config_file)
 
         # Create the population, which is the top-level object for a NEAT run.
-        p = neat.Population(config)
+        p = self.restore_population(config)
 
         # Add a stdout reporter to show progress in the terminal.
         p.add_reporter(neat.StdOutReporter(True))
         stats = neat.StatisticsReporter()
         p.add_reporter(stats)
-        p.add_reporter(neat.Checkpointer(5))
+        # Save only the new genomes of every generation, written in the background
+        self.checkpointer = CompactCheckpointer(1, self.checkpoint_dir, resume=self.resumed_generation)
+        p.add_reporter(self.checkpointer)
+        self.telemetry = TelemetryReporter(self.telemetry_dir, "pokemon_red")
+        p.add_reporter(self.telemetry)
+        for reporter in reporters:
+            p.add_reporter(reporter)
 
-        winner = p.run(self.eval_genomes, self.generations)
+        self.population = p
+        self.budget = EpisodeBudget.from_config(self.config_file)
+        self.stuck = StuckDetector.from_config(self.config_file)
+        self.create_novelty_archive()
+        # A shared pool already plays with its own encoder
+        self.encoder = pool.encoder if pool is not None else self.create_encoder(config)
+        # The encoder and the step limit are part of the environment, either changes the fitnesses
+        environment = self.encoder.basis.tobytes() + self.encoder.mean.tobytes() if self.encoder is not None else b""
+        if self.budget is not None:
+            environment += f"max_steps={self.budget.max_steps}".encode()
+        self.create_fitness_cache(self.config_file, environment)
+
+        # Boot long-lived emulators on every core, or on every worker daemon, and feed genomes to them, batch_size per worker in lockstep
+        # Episodes only need a fixed seed when their fitness is cached
+        seed = 0 if self.fitness_cache is not None else None
+        if pool is not None:
+            # A sweep hands every population a client of its shared pool, see sweep.py
+            self.pool = pool
+        elif self.workers:
+            self.pool = DistributedPool(self.workers, self.game_path, self.state_path, self.config_file, batch_size=self.batch_size, budget=self.budget, stuck=self.stuck, profile_every=self.profile_every, encoder=self.encoder, seed=seed)
+        else:
+            self.pool = WorkerPool(self.game_path, self.state_path, config, batch_size=self.batch_size, profile_every=self.profile_every, encoder=self.encoder, seed=seed, budget=self.budget, stuck=self.stuck, trace_dir=self.checkpoint_dir)
+        self.pool.start()
+        try:
+            winner = p.run(self.eval_genomes, self.generations)
+        finally:
+            self.pool.stop()
+            self.checkpointer.wait()
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self.coverage.save_heatmaps(os.path.join(self.checkpoint_dir, "coverage.npz"))
 
         # show final stats
         print('\nBest genome:\n{!s}'.format(winner))
+
+    def watch(self, genome, config, emulation_speed=1):
+        # Play a single genome in a window
+        if self.encoder is None:
+            self.encoder = self.create_encoder(config)
+        handler = PyBoyHandler(self.game_path, self.state_path, settings=EmulatorSettings.watch(emulation_speed), encoder=self.encoder, seed=0 if self.fitness_cache is not None else None, stuck=StuckDetector.from_config(self.config_file), trace_dir=self.checkpoint_dir)
+        fitness = handler.play(CompiledNetwork.create(genome, config), genome)
+        handler.end_game()
+        return fitness
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class ObservationBuffer:
+
+    def __init__(self, num_scalars, actions_offset, recent_actions, screen_shape=(144, 160), stack_size=3, scale_factor=2):
+        self.scale_factor = scale_factor
+        self.stack_size = stack_size
+        self.height = screen_shape[0] // scale_factor
+        self.width = screen_shape[1] // scale_factor
+        size = num_scalars + self.height * self.width * stack_size
+
+        # One contiguous float32 vector that is handed straight to the network
+        self.vector = np.zeros(size, dtype=np.float32)
+        self.scalars = self.vector[:num_scalars]
+        self.actions = self.vector[actions_offset:actions_offset + len(recent_actions)]
+        self.actions[:] = recent_actions
+
+        # Same (height, width, stack) layout as the old np.roll stack, newest frame in channel 0
+        self.pixels = self.vector[num_scalars:]
+        self.screens = self.pixels.reshape(self.height, self.width, stack_size)
+
+        # Downscaled frames live in a ring, frame_index points at the newest one
+        self.frames = np.zeros((stack_size, self.height, self.width), dtype=np.uint8)
+        self.frame_index = 0
+        self.phases = np.zeros((scale_factor, scale_factor, self.height, self.width), dtype=np.uint16)
+        self.block_sum = np.zeros((self.height, self.width), dtype=np.uint16)
+
+    def push_action(self, action_index):
+        self.actions[:-1] = self.actions[1:]
+        self.actions[-1] = action_index
+
+    def push_screen(self, screen):
+        self.downscale(screen)
+        self.stack_frame()
+
+    def downscale(self, screen):
+        factor = self.scale_factor
+        height = self.height * factor
+        width = self.width * factor
+
+        # Regroup the first channel by block phase, then add the phases with contiguous integer ops
+        blocks = screen[:height, :width, 0].reshape(self.height, factor, self.width, factor)
+        np.copyto(self.phases, blocks.transpose(1, 3, 0, 2))
+        phases = self.phases.reshape(-1, self.height, self.width)
+        np.copyto(self.block_sum, phases[0])
+        for phase in phases[1:]:
+            np.add(self.block_sum, phase, out=self.block_sum)
+        np.floor_divide(self.block_sum, factor * factor, out=self.block_sum)
+
+    def stack_frame(self):
+        # Integer block mean goes into the next ring slot
+        self.frame_index = (self.frame_index + 1) % self.stack_size
+        np.copyto(self.frames[self.frame_index], self.block_sum, casting="unsafe")
+
+        # Unroll the ring newest first into the observation, then normalise in place
+        for i in range(self.stack_size):
+            frame = self.frames[(self.frame_index - i) % self.stack_size]
+            np.copyto(self.screens[:, :, i], frame, casting="unsafe")
+        np.multiply(self.pixels, np.float32(1 / 255.0), out=self.pixels)
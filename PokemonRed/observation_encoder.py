@@ -0,0 +1,111 @@
+import hashlib
+import os
+import numpy as np
+
+
+class RandomNetwork:
+
+    # Presses random buttons while frames are sampled for fitting
+    def __init__(self, num_outputs, rng):
+        self.num_outputs = num_outputs
+        self.rng = rng
+
+    def activate(self, inputs):
+        return self.rng.random(self.num_outputs)
+
+
+class ObservationEncoder:
+
+    def __init__(self, basis, mean, num_scalars):
+        # basis is (features, pixels), the scalars are passed through unchanged
+        self.basis = basis
+        self.mean = mean
+        self.num_scalars = num_scalars
+        self.bias = basis @ mean
+        self.vector = np.zeros(num_scalars + len(basis), dtype=np.float32)
+        self.features = self.vector[num_scalars:]
+
+    def clone(self):
+        # Shares the basis but gets its own output buffer
+        return ObservationEncoder(self.basis, self.mean, self.num_scalars)
+
+    def encode(self, observation):
+        self.vector[:self.num_scalars] = observation[:self.num_scalars]
+        np.matmul(self.basis, observation[self.num_scalars:], out=self.features)
+        np.subtract(self.features, self.bias, out=self.features)
+        return self.vector
+
+    def save(self, path):
+        # One .npy file, first row is the mean and the rest is the basis
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, np.vstack([self.mean, self.basis]))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path, num_scalars):
+        data = np.load(path)
+        return ObservationEncoder(np.ascontiguousarray(data[1:]), data[0].copy(), num_scalars)
+
+    @staticmethod
+    def random_projection(num_pixels, num_features, num_scalars, seed=0):
+        # Gaussian projection scaled so every feature has about the spread of one pixel
+        rng = np.random.default_rng(seed)
+        basis = (rng.standard_normal((num_features, num_pixels)) / np.sqrt(num_pixels)).astype(np.float32)
+        return ObservationEncoder(basis, np.zeros(num_pixels, dtype=np.float32), num_scalars)
+
+    @staticmethod
+    def fit_pca(pixels, num_features, num_scalars):
+        # Principal components of the sampled frames, whitened to unit variance
+        mean = pixels.mean(axis=0)
+        _, s, vt = np.linalg.svd(pixels - mean, full_matrices=False)
+        count = min(num_features, len(s))
+        std = s[:count] / np.sqrt(max(len(pixels) - 1, 1))
+        basis = np.zeros((num_features, pixels.shape[1]), dtype=np.float32)
+        basis[:count] = vt[:count] / np.maximum(std, 1e-6)[:, None]
+        return ObservationEncoder(basis, mean.astype(np.float32), num_scalars)
+
+    @staticmethod
+    def sample_pixels(handler, count, seed=0):
+        # Play random buttons from the start state and keep the screen part of every observation
+        rng = np.random.default_rng(seed)
+        net = RandomNetwork(len(handler.trainer.actions), rng)
+        num_scalars = handler.trainer.observation.scalars.size
+        pixels = np.zeros((count, handler.trainer.observation.pixels.size), dtype=np.float32)
+
+        handler.begin_episode(net, None)
+        for i in range(count):
+            observation = handler.observe()
+            if observation is None:
+                break
+            pixels[i] = observation[num_scalars:]
+            if handler.act(net.activate(observation)):
+                handler.begin_episode(net, None)
+        return pixels
+
+    @staticmethod
+    def for_inputs(num_inputs, handler, kind="pca", cache_dir="ROM/states/encoders", samples=1000, seed=0):
+        # None when the network takes the raw observation, otherwise the encoder that shrinks it to num_inputs
+        observation = handler.trainer.observation
+        num_scalars = observation.scalars.size
+        num_pixels = observation.pixels.size
+        if num_inputs == num_scalars + num_pixels:
+            return None
+        num_features = num_inputs - num_scalars
+        if num_features <= 0 or num_features > num_pixels:
+            raise ValueError(f"num_inputs must be {num_scalars + num_pixels} or between {num_scalars + 1} and {num_scalars + num_pixels}, got {num_inputs}")
+
+        # A basis is only valid for the start state it was fitted on
+        key = hashlib.sha1(handler.state + f"{kind}:{num_features}:{samples}:{seed}".encode()).hexdigest()
+        path = os.path.join(cache_dir, f"{kind}-{num_features}-{key[:16]}.npy")
+        if os.path.exists(path):
+            return ObservationEncoder.load(path, num_scalars)
+
+        if kind == "random":
+            encoder = ObservationEncoder.random_projection(num_pixels, num_features, num_scalars, seed)
+        elif kind == "pca":
+            encoder = ObservationEncoder.fit_pca(ObservationEncoder.sample_pixels(handler, samples, seed), num_features, num_scalars)
+        else:
+            raise ValueError(f"Unknown encoder {kind}, expected pca or random")
+        encoder.save(path)
+        return encoder
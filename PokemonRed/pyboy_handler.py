@@ -1,97 +1,212 @@
-from pyboy import PyBoy
 from trainer import Trainer
-import asyncio
+from frame_skip import FrameSkip
+from emulator_settings import EmulatorSettings
+from profiler import StepProfiler
+from memory_addresses import BATTLE_FLAG_ADDRESS
+from snapshot_cache import SnapshotCache
+from exploration_map import ExplorationMap
+import hashlib
+import io
+import os
+import resource
+import socket
+import time
+
+# Button presses from power-on to the overworld as (button, ticks to wait after it)
+INTRO_SCRIPT = (
+    # Skip Intro
+    [(None, 500), ('start', 300)]
+    # Select Start Game
+    + [('a', 300)]
+    # Oak text
+    + [('a', 300)] * 16
+    # Select name
+    + [('down', 300)] + [('a', 300)] * 6
+    + [('down', 300)] + [('a', 300)] * 9
+)
 
 class PyBoyHandler:
-    
-    def __init__(self, game_path="ROM/PokemonRed.gb", state_path=None, net=None, genome=None):
-        
-        # For no window -> window="null"
-        
-        self.pyboy = PyBoy(game_path, sound_volume=0, window="null")
+
+    def __init__(self, game_path="ROM/PokemonRed.gb", state_path=None, net=None, genome=None, state=None, settings=None, wait_for_action=150, save_traces=True, profile_every=0, encoder=None, snapshot_dir="ROM/states/snapshots", seed=None, budget=None, stuck=None, trace_dir="checkpoints"):
+
+        # Headless and unthrottled unless other settings are given, e.g. EmulatorSettings.watch()
+        self.settings = settings if settings is not None else EmulatorSettings.training()
+        self.pyboy = self.settings.create_pyboy(game_path)
+        self.game_path = game_path
         self.state_path = state_path
         self.net = net
         self.genome = genome
-        self.trainer = Trainer(self.pyboy, net, genome)
+        # Frames are repeated after every decision and only the observed one is rendered
+        self.frame_skip = FrameSkip(self.pyboy, wait_for_action + 1, [BATTLE_FLAG_ADDRESS], check_every=10, render_every_frame=self.settings.render == "always")
+        # Opt-in step profiling, sampled every profile_every steps
+        self.profiler = StepProfiler(profile_every) if profile_every > 0 else None
+        self.frame_skip.profiler = self.profiler
+        # Exploration counts are cleared between episodes instead of reallocated
+        self.exploration = ExplorationMap()
+        # Every emulator encodes into its own buffer
+        self.encoder = encoder.clone() if encoder is not None else None
+        # Seed of the initial recent actions, None draws them at random every episode
+        self.seed = seed
+        # Optional step, time and quorum limits of every episode, see EpisodeBudget
+        self.budget = budget
+        # Optional detector that ends or penalises episodes repeating the same state, see StuckDetector
+        self.stuck = stuck.clone() if stuck is not None else None
+        self.steps = 0
+        self.started = 0.0
+        self.first_frame = 0
+        self.truncated = None
+        # Telemetry groups episodes by the process that played them
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.trainer = Trainer(self.pyboy, net, genome, self.frame_skip, self.exploration, self.encoder, self.seed, self.stuck)
         self.final_reward = 0
-
-        if self.state_path is not None:
-            self.open_state()
-            
         self.apply_configuration()
-        
+
+        # Keep the start state in memory so the emulator can be reset without touching the disk
+        if state is not None:
+            self.state = state
+        elif self.state_path is not None:
+            self.state = self.read_state()
+        else:
+            # Play the intro once and start every episode from the snapshot taken after it
+            snapshots = SnapshotCache(game_path, snapshot_dir)
+            self.state = snapshots.get(self.pyboy, INTRO_SCRIPT, self.skip_intro)
+
+        self.open_state()
+
+        # Everything a replay needs to reproduce an episode from a recorded action trace
+        self.save_traces = save_traces
+        self.trace_dir = trace_dir
+        # Trace of the last episode, sent back with its stats so the coordinator can file it
+        self.trace_path = None
+        with open(game_path, "rb") as f:
+            rom_hash = hashlib.sha1(f.read()).hexdigest()
+        self.trace_header = {
+            "rom_hash": rom_hash,
+            "state_hash": hashlib.sha1(self.state).hexdigest(),
+            "wait_for_action": wait_for_action,
+            "watch_addresses": self.frame_skip.watch_addresses,
+            "check_every": self.frame_skip.check_every,
+            # Limits that end an episode early or change its rewards, a replay needs the same ones
+            "stuck": None if self.stuck is None else {"max_repeats": self.stuck.max_repeats, "max_period": self.stuck.max_period, "penalty": self.stuck.penalty, "terminate": self.stuck.terminate},
+            "budget": None if self.budget is None else {"max_steps": self.budget.max_steps, "max_seconds": self.budget.max_seconds},
+        }
+
     def apply_configuration(self):
-        self.pyboy.set_emulation_speed(10)
-    
+        self.pyboy.set_emulation_speed(self.settings.emulation_speed)
+
     def start_game(self):
-        if self.state_path is None:
-            self.pyboy.set_emulation_speed(10)
-            self.skip_intro()
-        
         # Normal game loop
+        self.game_loop()
+        return self.end_game()
+
+    def play(self, net, genome):
+        # Reuse the running emulator for a new genome
+        self.begin_episode(net, genome)
         return self.game_loop()
-        
+
+    def begin_episode(self, net, genome):
+        self.reset_game(net, genome)
+
     def game_loop(self):
-        end_game = False
-        
-        while self.pyboy.tick():
-            end_game, reward = self.trainer.step()
-            self.final_reward += reward
-            if end_game:
+        while True:
+            observation = self.observe()
+            if observation is None:
                 break
-            
-        self.trainer.save_actions(self.final_reward)
-            
-        return self.end_game()
-        
-    def reset_game(self):
-        self.pyboy.stop()
-        self.pyboy = PyBoy(self.game_path, sound_volume=0)
-        self.apply_configuration()
-        self.start_game()
+            result = self.net.activate(observation)
+            if self.profiler is not None:
+                self.profiler.mark("activate")
+            if self.act(result):
+                break
+
+        return self.finish_episode()
+
+    def observe(self):
+        # Build the next observation, None once the emulator has quit or the budget is spent
+        if not self.frame_skip.running:
+            return None
+        if self.budget is not None:
+            self.truncated = self.budget.exceeded(self.steps, self.started)
+            if self.truncated is not None:
+                return None
+        self.steps += 1
+        profiler = self.profiler
+        if profiler is None:
+            return self.trainer.begin_step()
+
+        profiler.begin()
+        observation = self.trainer.begin_step()
+        profiler.mark("observe")
+        return observation
+
+    def act(self, result):
+        end_game, reward = self.trainer.end_step(result)
+        self.final_reward += reward
+        if self.profiler is not None:
+            self.profiler.mark("reward")
+            self.profiler.end()
+        return end_game or not self.frame_skip.running
+
+    def finish_episode(self):
+        if self.save_traces:
+            self.trace_path = self.trainer.save_actions(self.final_reward, self.trace_header, self.trace_dir)
+
+        return self.final_reward
+
+    def episode_stats(self):
+        # Sent back with the fitness so the coordinator can report coverage across the generation
+        stats = {"visited": self.exploration.visited.tobytes(), "steps": self.steps, "truncated": self.truncated, "stuck": self.stuck is not None and self.stuck.detected, "behaviour": self.trainer.behaviour() if self.truncated != "unplayed" else None, "trace": self.trace_path}
+        stats.update(self.telemetry())
+        if self.profiler is not None:
+            stats["profile"] = self.profiler.report()
+        return stats
+
+    def telemetry(self):
+        # Throughput and memory of this worker, ru_maxrss is in kilobytes on Linux
+        return {
+            "worker": self.worker_id,
+            "frames": self.pyboy.frame_count - self.first_frame,
+            "seconds": time.perf_counter() - self.started,
+            "finished": time.time(),
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "rewards": dict(self.trainer.reward_counts),
+        }
+
+    def reset_game(self, net, genome):
+        self.net = net
+        self.genome = genome
+        if self.stuck is not None:
+            self.stuck.reset()
+        self.exploration.reset()
+        self.trainer = Trainer(self.pyboy, net, genome, self.frame_skip, self.exploration, self.encoder, self.seed, self.stuck)
+        self.final_reward = 0
+        self.steps = 0
+        self.truncated = None
+        self.trace_path = None
+        self.open_state()
+        self.started = time.perf_counter()
+        self.first_frame = self.pyboy.frame_count
 
     def end_game(self):
         self.pyboy.stop()
         return self.final_reward
-        
-    def open_state(self):
+
+    def read_state(self):
         with open(self.state_path, "rb") as f:
-            self.pyboy.load_state(f)
-        
+            return f.read()
+
+    def save_state(self):
+        state = io.BytesIO()
+        self.pyboy.save_state(state)
+        return state.getvalue()
+
+    def open_state(self):
+        self.pyboy.load_state(io.BytesIO(self.state))
+
+        # Render the first frame the genome observes
+        self.frame_skip.running = self.pyboy.tick(1, True)
+
     def skip_intro(self):
-        
-        # Skip Intro
-        self.pyboy.tick(500)
-        self.pyboy.button('start')
-        self.pyboy.tick(300)
-
-        # Select Start Game
-        self.pyboy.button('a')
-        self.pyboy.tick(300)
-        
-        # Oak text
-        for i in range(16):
-            self.pyboy.button('a')
-            self.pyboy.tick(300)
-            
-        # Select name
-        self.pyboy.button('down')
-        self.pyboy.tick(300)
-        
-        for i in range(6):
-            self.pyboy.button('a')
-            self.pyboy.tick(300)
-            
-        self.pyboy.button('down')
-        self.pyboy.tick(300)
-        
-        for i in range(9):
-            self.pyboy.button('a')
-            self.pyboy.tick(300)
-            
-        
-            
-        
-            
-        
-    
\ No newline at end of file
+        for button, ticks in INTRO_SCRIPT:
+            if button is not None:
+                self.pyboy.button(button)
+            self.pyboy.tick(ticks)
@@ -0,0 +1,142 @@
+import numpy as np
+
+# Measured on PyBoy 2: a memory slice costs about as much as 8 single reads plus 0.04 us per byte,
+# so sparse groups of addresses are read byte by byte and only dense groups as one slice.
+# Short rows of a tile map stay single reads too: the 18 rows of 10 tiles of the Tetris playfield read in 17 us
+# byte by byte, 22 us as 18 row slices and 41 us as one slice over the gaps between the rows
+SLICE_MIN_LENGTH = 14
+MERGE_GAP = 16
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+class Field:
+
+    # A window field decodes its offsets as one slice of the buffer
+    window = False
+
+    def __init__(self, *addresses):
+        self.addresses = addresses
+
+    def read_addresses(self):
+        return self.addresses
+
+
+class Byte(Field):
+
+    def decode(self, snapshot, offsets):
+        return snapshot.data[offsets[0]]
+
+
+class Bytes(Field):
+
+    def decode(self, snapshot, offsets):
+        data = snapshot.data
+        return [data[offset] for offset in offsets]
+
+
+class Words(Field):
+
+    # Big-endian 16-bit values, each address is the high byte
+    def read_addresses(self):
+        return [a for address in self.addresses for a in (address, address + 1)]
+
+    def decode(self, snapshot, offsets):
+        data = snapshot.data
+        return [(data[offsets[i]] << 8) | data[offsets[i + 1]] for i in range(0, len(offsets), 2)]
+
+
+class Bcd(Field):
+
+    # Packed binary coded decimal, most significant byte first
+    def decode(self, snapshot, offsets):
+        value = 0
+        for offset in offsets:
+            byte = snapshot.data[offset]
+            value = value * 100 + (byte >> 4) * 10 + (byte & 0x0F)
+        return value
+
+
+class BitCount(Field):
+
+    # Number of set bits in the range start..end inclusive, e.g. event flags
+    window = True
+
+    def __init__(self, start, end):
+        super().__init__(*range(start, end + 1))
+
+    def decode(self, snapshot, offsets):
+        return int(POPCOUNT[snapshot.values[offsets[0]:offsets[-1] + 1]].sum())
+
+
+class Tiles(Field):
+
+    # A rows x cols window of a 32-wide background tile map, returned as a view of the buffer
+    window = True
+
+    def __init__(self, start, rows, cols, stride=32):
+        super().__init__(*[start + row * stride + col for row in range(rows) for col in range(cols)])
+        self.shape = (rows, cols)
+
+    def decode(self, snapshot, offsets):
+        return snapshot.values[offsets[0]:offsets[-1] + 1].reshape(self.shape)
+
+
+class RamSchema:
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+        # Every address gets one slot in the buffer, in address order so ranges stay contiguous
+        addresses = sorted({a for field in fields.values() for a in field.read_addresses()})
+        self.size = len(addresses)
+        slots = {a: i for i, a in enumerate(addresses)}
+        self.offsets = {name: [slots[a] for a in field.read_addresses()] for name, field in fields.items()}
+        for name, field in fields.items():
+            offsets = self.offsets[name]
+            if field.window and offsets != list(range(offsets[0], offsets[0] + len(offsets))):
+                raise ValueError(f"Addresses of other fields fall inside {name}, read it with a schema of its own")
+
+        # Group nearby addresses, groups with many addresses are read as one slice and the rest byte by byte
+        self.ranges = []
+        self.bytes = []
+        group = []
+        for address in addresses + [None]:
+            if group and (address is None or address - group[-1] > MERGE_GAP):
+                if len(group) >= SLICE_MIN_LENGTH:
+                    self.ranges.append((group[0], group[-1] + 1, [slots[a] for a in group], [a - group[0] for a in group]))
+                else:
+                    self.bytes.extend((a, slots[a]) for a in group)
+                group = []
+            if address is not None:
+                group.append(address)
+
+    def snapshot(self, pyboy):
+        return RamSnapshot(self, pyboy)
+
+
+class RamSnapshot:
+
+    def __init__(self, schema, pyboy):
+        self.schema = schema
+        self.memory = pyboy.memory
+        self.data = bytearray(schema.size)
+        self.values = np.frombuffer(self.data, dtype=np.uint8)
+
+    def read(self):
+        # One pass over the schema per step, fields are decoded from the buffer afterwards
+        data = self.data
+        memory = self.memory
+        for address, slot in self.schema.bytes:
+            data[slot] = memory[address]
+        for start, end, slots, positions in self.schema.ranges:
+            block = memory[start:end]
+            if len(slots) == end - start:
+                data[slots[0]:slots[-1] + 1] = block
+            else:
+                for slot, position in zip(slots, positions):
+                    data[slot] = block[position]
+        return self
+
+    def __getitem__(self, name):
+        return self.schema.fields[name].decode(self, self.schema.offsets[name])
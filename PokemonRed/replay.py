@@ -0,0 +1,41 @@
+from pyboy_handler import PyBoyHandler
+from emulator_settings import EmulatorSettings
+from action_trace import ActionTrace, ReplayNetwork
+from stuck_detector import StuckDetector
+from episode_budget import EpisodeBudget
+import sys
+
+
+def replay(trace_path, game_path="ROM/PokemonRed.gb", state_path="ROM/states/has_pokedex.state", settings=None):
+    trace = ActionTrace.load(trace_path)
+    header = trace.header
+
+    # Traces recorded before the header carried the stuck detector and budget are replayed without them
+    stuck = StuckDetector(**header["stuck"]) if header.get("stuck") else None
+    # The clock is left off, an episode it ended stops where its trace runs out
+    budget = EpisodeBudget(max_steps=header["budget"]["max_steps"]) if header.get("budget") else None
+    handler = PyBoyHandler(game_path, state_path, settings=settings, wait_for_action=header["wait_for_action"], save_traces=False, budget=budget, stuck=stuck)
+    try:
+        # A trace only reproduces its episode on the exact ROM and start state it was recorded on
+        for name in ("rom_hash", "state_hash"):
+            if handler.trace_header[name] != header[name]:
+                raise ValueError(f"{name} does not match the trace: {handler.trace_header[name]} != {header[name]}")
+
+        net = ReplayNetwork(trace.actions, len(header["actions"]))
+        handler.begin_episode(net, None)
+        while not net.exhausted:
+            observation = handler.observe()
+            if observation is None or handler.act(net.activate(observation)):
+                break
+        fitness = handler.finish_episode()
+    finally:
+        handler.end_game()
+
+    return {"fitness": fitness, "steps": net.position, "recorded_fitness": header["fitness"], "recorded_steps": len(trace), "match": fitness == header["fitness"] and net.position == len(trace)}
+
+
+if __name__ == "__main__":
+    watch = "--watch" in sys.argv
+    result = replay(sys.argv[1], settings=EmulatorSettings.watch() if watch else None)
+    print(f"fitness {result['fitness']} (recorded {result['recorded_fitness']}), steps {result['steps']} (recorded {result['recorded_steps']})")
+    print("match" if result["match"] else "MISMATCH")
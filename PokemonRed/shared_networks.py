@@ -0,0 +1,87 @@
+from multiprocessing import shared_memory
+from compiled_network import CompiledNetwork, Layer, ACTIVATIONS
+from scipy import sparse
+import numpy as np
+
+ACTIVATION_FUNCTIONS = list(ACTIVATIONS.values())
+ACTIVATION_IDS = {activation: i for i, activation in enumerate(ACTIVATION_FUNCTIONS)}
+
+# One row per genome slot of a results block, written by the worker that plays the genome
+RESULT_DTYPE = np.dtype([("fitness", np.float64), ("owner", np.int64)])
+
+
+def network_arrays(net):
+    # Header of sizes, then the arrays of every layer in a fixed order, all 8 byte items so every view is aligned
+    header = [net.num_inputs, len(net.output_index), len(net.layers)]
+    arrays = [np.asarray(net.output_index, dtype=np.int64)]
+    for layer in net.layers:
+        width = layer.end - layer.start
+        activation = np.zeros(width, dtype=np.int64)
+        for function, index in layer.activations:
+            activation[slice(None) if index is None else index] = ACTIVATION_IDS[function]
+        arrays += [layer.bias, layer.response, activation]
+        if sparse.issparse(layer.weights):
+            header += [layer.start, width, layer.weights.nnz]
+            arrays += [layer.weights.data, layer.weights.indices.astype(np.int64), layer.weights.indptr.astype(np.int64)]
+        else:
+            header += [layer.start, width, -1]
+            arrays.append(layer.weights)
+    return [np.array(header, dtype=np.int64)] + [np.ascontiguousarray(array) for array in arrays]
+
+
+def write_network(net):
+    # The compiled network in a block of its own, written once and mapped by whichever worker plays it
+    arrays = network_arrays(net)
+    block = shared_memory.SharedMemory(create=True, size=sum(array.nbytes for array in arrays))
+    offset = 0
+    for array in arrays:
+        np.frombuffer(block.buf, array.dtype, array.size, offset)[:] = array.ravel()
+        offset += array.nbytes
+    return block
+
+
+def read_network(buffer):
+    # Rebuild the network on views of the block, nothing is copied
+    offset = 0
+
+    def take(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(buffer, dtype, count, offset)
+        offset += array.nbytes
+        return array
+
+    num_inputs, num_outputs, num_layers = take(np.int64, 3).tolist()
+    layout = take(np.int64, 3 * num_layers).reshape(-1, 3).tolist()
+    output_index = take(np.int64, num_outputs)
+    layers = []
+    for start, width, nnz in layout:
+        bias = take(np.float64, width)
+        response = take(np.float64, width)
+        activation = take(np.int64, width)
+        if nnz < 0:
+            weights = take(np.float64, width * start).reshape(width, start)
+        else:
+            data = take(np.float64, nnz)
+            indices = take(np.int64, nnz)
+            indptr = take(np.int64, width + 1)
+            weights = sparse.csr_matrix((data, indices, indptr), shape=(width, start), copy=False)
+        layers.append(Layer(start, range(width), weights, bias, response, activation_groups(activation)))
+    return CompiledNetwork(num_inputs, layers, output_index)
+
+
+def activation_groups(activation):
+    # Same grouping as CompiledNetwork.create, a single activation applies to the whole layer
+    ids = np.unique(activation)
+    if len(ids) == 1:
+        return [(ACTIVATION_FUNCTIONS[ids[0]], None)]
+    return [(ACTIVATION_FUNCTIONS[i], np.flatnonzero(activation == i)) for i in ids]
+
+
+def results_block(capacity):
+    block = shared_memory.SharedMemory(create=True, size=capacity * RESULT_DTYPE.itemsize)
+    results_view(block)[:] = 0
+    return block
+
+
+def results_view(block):
+    return np.ndarray(block.size // RESULT_DTYPE.itemsize, dtype=RESULT_DTYPE, buffer=block.buf)
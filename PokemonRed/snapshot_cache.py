@@ -0,0 +1,45 @@
+import hashlib
+import io
+import os
+
+
+class SnapshotCache:
+
+    def __init__(self, game_path, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.snapshots = {}
+
+        with open(game_path, "rb") as f:
+            self.rom_hash = hashlib.sha1(f.read()).hexdigest()
+
+    def key(self, script):
+        # A snapshot is only valid for the same ROM and the same scripted inputs
+        return hashlib.sha1((self.rom_hash + repr(script)).encode()).hexdigest()
+
+    def get(self, pyboy, script, run_script):
+        key = self.key(script)
+        if key in self.snapshots:
+            return self.snapshots[key]
+
+        path = os.path.join(self.cache_dir, f"{key}.state") if self.cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                snapshot = f.read()
+        else:
+            run_script()
+            buffer = io.BytesIO()
+            pyboy.save_state(buffer)
+            snapshot = buffer.getvalue()
+            if path is not None:
+                self.write(path, snapshot)
+
+        self.snapshots[key] = snapshot
+        return snapshot
+
+    def write(self, path, snapshot):
+        # Write to a temporary file first so parallel workers never read a partial snapshot
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(snapshot)
+        os.replace(tmp_path, path)
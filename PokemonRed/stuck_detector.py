@@ -0,0 +1,50 @@
+from collections import deque
+import configparser
+import zlib
+
+
+class StuckDetector:
+
+    def __init__(self, max_repeats=50, max_period=8, penalty=0.0, terminate=True):
+        # An episode is stuck once every state for max_repeats decisions in a row was already seen within the last
+        # max_period decisions, e.g. a screen that never changes (period 1) or an agent walking back and forth
+        self.max_repeats = max_repeats
+        self.max_period = max_period
+        # Added to the reward of every stuck decision, negative to punish stalling
+        self.penalty = penalty
+        self.terminate = terminate
+        self.recent = deque(maxlen=max_period)
+        self.repeats = 0
+        self.detected = False
+
+    @staticmethod
+    def from_config(config_file):
+        # None when the config has no [StuckDetector] section or turns it off with max_repeats = 0
+        parser = configparser.ConfigParser()
+        parser.read(config_file)
+        if not parser.has_section("StuckDetector"):
+            return None
+        section = parser["StuckDetector"]
+        detector = StuckDetector(section.getint("max_repeats", fallback=50), section.getint("max_period", fallback=8), section.getfloat("penalty", fallback=0.0), section.getboolean("terminate", fallback=True))
+        return detector if detector.max_repeats > 0 else None
+
+    def clone(self):
+        # Every emulator tracks its own episode
+        return StuckDetector(self.max_repeats, self.max_period, self.penalty, self.terminate)
+
+    def reset(self):
+        self.recent.clear()
+        self.repeats = 0
+        self.detected = False
+
+    def update(self, data):
+        # data holds the RAM bytes of the state after a decision, True while the episode is stuck
+        digest = zlib.crc32(data)
+        if digest in self.recent:
+            self.repeats += 1
+        else:
+            self.repeats = 0
+        self.recent.append(digest)
+        if self.repeats >= self.max_repeats:
+            self.detected = True
+        return self.repeats >= self.max_repeats
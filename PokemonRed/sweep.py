@@ -0,0 +1,388 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import count, product
+from queue import Queue
+from neat.reporting import BaseReporter
+from worker_pool import WorkerPool
+from model_handler import ModelHandler
+from episode_budget import EpisodeBudget
+from stuck_detector import StuckDetector
+from fast_species import FastSpeciesSet
+from array_genome import ArrayGenome
+from action_trace import ActionTrace
+import configparser
+import csv
+import json
+import math
+import neat
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+
+# Parameters that change the episodes themselves, only trials that agree on all of them share emulators
+ENVIRONMENT_SECTIONS = {"PyBoyHandler", "EpisodeBudget", "StuckDetector"}
+ENVIRONMENT_KEYS = {"num_inputs", "num_outputs"}
+# Emulator settings a spec can change as PyBoyHandler.<name>, every other parameter is a NEAT config key as <section>.<key>
+HANDLER_SETTINGS = {"wait_for_action": int}
+
+
+class TrialPruned(Exception):
+    pass
+
+
+def expand(spec):
+    # Parameter sets of a grid or random search. Lists are choices, {"min", "max", "log"} are ranges for random search
+    params = spec["params"]
+    if spec.get("search", "grid") == "grid":
+        for name, values in params.items():
+            if not isinstance(values, list):
+                raise ValueError(f"Grid search needs a list of values for {name}")
+        return [dict(zip(params, values)) for values in product(*params.values())]
+
+    rng = random.Random(spec.get("seed", 0))
+    trials = []
+    for _ in range(spec.get("samples", 10)):
+        trial = {}
+        for name, values in params.items():
+            if isinstance(values, list):
+                trial[name] = rng.choice(values)
+            elif values.get("log"):
+                trial[name] = math.exp(rng.uniform(math.log(values["min"]), math.log(values["max"])))
+            elif isinstance(values["min"], int) and isinstance(values["max"], int):
+                trial[name] = rng.randint(values["min"], values["max"])
+            else:
+                trial[name] = rng.uniform(values["min"], values["max"])
+        trials.append(trial)
+    return trials
+
+
+class Trial:
+
+    def __init__(self, index, params, directory, seed):
+        self.index = index
+        self.params = params
+        self.directory = directory
+        # Seeds the random module while this trial breeds, the same seed evolves the same populations
+        self.seed = seed
+        self.config_file = os.path.join(directory, "config-neat.txt")
+        self.status = "waiting"
+        # Best fitness so far after every generation
+        self.curve = []
+        self.seconds = 0.0
+        self.error = None
+
+    def best(self):
+        return self.curve[-1] if self.curve else None
+
+    def environment(self):
+        return tuple(sorted((name, value) for name, value in self.params.items() if name.split(".")[0] in ENVIRONMENT_SECTIONS or name.split(".")[-1] in ENVIRONMENT_KEYS))
+
+    def handler_settings(self):
+        settings = {}
+        for name, value in self.params.items():
+            section, _, key = name.partition(".")
+            if section == "PyBoyHandler":
+                if key not in HANDLER_SETTINGS:
+                    raise ValueError(f"{name} is not a setting a sweep can change, only {sorted(HANDLER_SETTINGS)}")
+                settings[key] = HANDLER_SETTINGS[key](value)
+        return settings
+
+    def write_config(self, base_config):
+        # The base config with this trial's NEAT parameters, emulator settings go to the pool instead
+        parser = configparser.ConfigParser()
+        parser.read(base_config)
+        for name, value in self.params.items():
+            section, _, key = name.partition(".")
+            if section == "PyBoyHandler":
+                continue
+            if not parser.has_section(section):
+                raise ValueError(f"{name} names a section that is not in {base_config}")
+            parser.set(section, key, str(value))
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.config_file, "w") as f:
+            parser.write(f)
+
+
+class FitnessCurve(BaseReporter):
+
+    def __init__(self, sweep, trial):
+        self.sweep = sweep
+        self.trial = trial
+
+    def post_evaluate(self, config, population, species, best_genome):
+        # Raising here ends Population.run of the trial before it breeds another generation
+        best = self.trial.best()
+        self.trial.curve.append(best_genome.fitness if best is None else max(best, best_genome.fitness))
+        if self.sweep.hopeless(self.trial):
+            raise TrialPruned()
+
+
+class SharedPool:
+
+    def __init__(self, pool):
+        # One WorkerPool fed by several populations. Populations with queued genomes take turns one batch at a time,
+        # and only a bounded number of genomes is handed to the workers so a new generation never waits behind a whole other one
+        self.pool = pool
+        self.capacity = 2 * pool.num_workers * pool.batch_size
+        self.queues = {}
+        self.turns = deque()
+        # NEAT breeds with the random module, so populations take turns breeding, each with its own random state,
+        # and only their episodes overlap. A trial then evolves the same however the others interleave with it
+        self.breeding = threading.Lock()
+        # Genomes of all populations in flight under keys of their own, population genome keys overlap
+        self.jobs = {}
+        self.job_keys = count(1)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.clients = []
+        self.error = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.pool.start()
+        self.running = True
+        self.thread = threading.Thread(target=self.dispatch, daemon=True)
+        self.thread.start()
+
+    def client(self, seed, trace_dir):
+        client = PoolClient(self, seed, trace_dir)
+        self.clients.append(client)
+        return client
+
+    def enqueue(self, client, batches):
+        with self.lock:
+            if self.error is not None:
+                raise RuntimeError(f"Shared pool failed: {self.error}")
+            self.queues[client] = deque(batches)
+            self.turns.append(client)
+
+    def cancel(self, client):
+        with self.lock:
+            self.queues.pop(client, None)
+            if client in self.turns:
+                self.turns.remove(client)
+
+    def dispatch(self):
+        while self.running:
+            self.submit_next()
+            try:
+                finished = self.pool.collect(timeout=0.1)
+            except RuntimeError as e:
+                self.fail(e)
+                return
+            with self.lock:
+                for job_key, fitness, stats in finished:
+                    client, genome_key = self.jobs.pop(job_key)
+                    self.in_flight -= 1
+                    if stats.get("trace") is not None:
+                        stats["trace"] = client.file_trace(stats["trace"], genome_key)
+                    client.results.put((genome_key, fitness, stats))
+
+    def submit_next(self):
+        while True:
+            with self.lock:
+                if not self.turns or self.in_flight >= self.capacity:
+                    return
+                client = self.turns.popleft()
+                batch = self.queues[client].popleft()
+                if self.queues[client]:
+                    self.turns.append(client)
+                else:
+                    del self.queues[client]
+                jobs = []
+                for genome_key, genome in batch:
+                    job_key = next(self.job_keys)
+                    self.jobs[job_key] = (client, genome_key)
+                    jobs.append((job_key, genome))
+                self.in_flight += len(jobs)
+            self.pool.submit(jobs)
+
+    def fail(self, error):
+        # Every population waiting for results gets the error instead
+        with self.lock:
+            self.error = error
+            self.queues = {}
+            self.turns.clear()
+        for client in self.clients:
+            client.results.put(None)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.pool.stop()
+
+
+class PoolClient:
+
+    def __init__(self, shared, seed, trace_dir):
+        # What ModelHandler expects of a pool, backed by the shared one
+        self.shared = shared
+        self.random_state = random.Random(seed).getstate()
+        # Traces of this population's episodes, the workers save them under job keys in the pool's directory
+        self.trace_dir = trace_dir
+        self.num_workers = shared.pool.num_workers
+        self.encoder = shared.pool.encoder
+        self.results = Queue()
+        self.stats = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.shared.cancel(self)
+
+    def begin(self):
+        # Wait for this population's turn to breed, with the random state it left off with
+        self.shared.breeding.acquire()
+        random.setstate(self.random_state)
+
+    def pause(self):
+        self.random_state = random.getstate()
+        self.shared.breeding.release()
+
+    def file_trace(self, path, genome_key):
+        # Move a trace to this trial under the key of its genome
+        trace = ActionTrace.load(path)
+        trace.header["genome_key"] = genome_key
+        os.makedirs(self.trace_dir, exist_ok=True)
+        target = os.path.join(self.trace_dir, f"{genome_key}_actions.trace")
+        trace.save(target)
+        os.remove(path)
+        return target
+
+    def evaluate(self, genomes, expected_steps=None):
+        # Longest expected episodes go first, split like WorkerPool.evaluate so every worker gets a share
+        if expected_steps:
+            genomes = sorted(genomes, key=lambda item: -expected_steps.get(item[0], 0))
+        size = max(1, min(self.shared.pool.batch_size, math.ceil(len(genomes) / self.num_workers)))
+        if genomes:
+            self.shared.enqueue(self, [genomes[i:i + size] for i in range(0, len(genomes), size)])
+
+        # The other populations breed while this one waits for its episodes
+        fitnesses = {}
+        self.stats = {}
+        self.pause()
+        try:
+            while len(fitnesses) < len(genomes):
+                result = self.results.get()
+                if result is None:
+                    raise RuntimeError(f"Shared pool failed: {self.shared.error}")
+                genome_key, fitness, stats = result
+                fitnesses[genome_key] = fitness
+                self.stats[genome_key] = stats
+        finally:
+            self.begin()
+        return fitnesses
+
+
+class Sweep:
+
+    def __init__(self, spec_file="sweep.json", directory="sweep"):
+        with open(spec_file) as f:
+            self.spec = json.load(f)
+        self.directory = directory
+        self.base_config = self.spec.get("config_file", "config-neat.txt")
+        self.generations = self.spec.get("generations", 20)
+        # Populations evolving at once on the shared pool
+        self.concurrent = self.spec.get("concurrent", 4)
+        prune = self.spec.get("prune", {})
+        self.min_generations = prune.get("min_generations", 5)
+        self.min_trials = prune.get("min_trials", 3)
+        seeds = random.Random(self.spec.get("seed", 0))
+        self.trials = [Trial(i, params, os.path.join(directory, f"trial-{i:03d}"), seeds.getrandbits(32)) for i, params in enumerate(expand(self.spec))]
+        self.summary_path = os.path.join(directory, "summary.csv")
+        self.lock = threading.Lock()
+
+    def run(self):
+        for trial in self.trials:
+            trial.write_config(self.base_config)
+
+        # Trials that play different episodes need emulators of their own, their groups run one after another
+        groups = {}
+        for trial in self.trials:
+            groups.setdefault(trial.environment(), []).append(trial)
+        for trials in groups.values():
+            self.run_group(trials)
+
+        self.write_summary()
+        self.print_summary()
+
+    def run_group(self, trials):
+        handlers = [self.model_handler(trial) for trial in trials]
+        first = handlers[0]
+        config = neat.Config(ArrayGenome.select(first.config_file), neat.DefaultReproduction, FastSpeciesSet.select(first.config_file), neat.DefaultStagnation, first.config_file)
+        # Every trial plays the same episodes, so fitness curves of different configs compare
+        pool = WorkerPool(first.game_path, first.state_path, config, batch_size=first.batch_size, seed=0, budget=EpisodeBudget.from_config(first.config_file), stuck=StuckDetector.from_config(first.config_file), encoder=first.create_encoder(config), trace_dir=os.path.join(self.directory, "traces"), **trials[0].handler_settings())
+        shared = SharedPool(pool)
+        shared.start()
+        try:
+            with ThreadPoolExecutor(self.concurrent) as executor:
+                for trial, handler in zip(trials, handlers):
+                    executor.submit(self.run_trial, trial, handler, shared)
+        finally:
+            shared.stop()
+
+    def model_handler(self, trial):
+        options = {key: self.spec[key] for key in ("game_path", "state_path", "batch_size", "encoder") if key in self.spec}
+        return ModelHandler(config_file=trial.config_file, generations=self.generations, checkpoint_dir=os.path.join(trial.directory, "checkpoints"), telemetry_dir=os.path.join(trial.directory, "telemetry"), fitness_cache_path=os.path.join(trial.directory, "fitness-cache.json"), **options)
+
+    def run_trial(self, trial, handler, shared):
+        trial.status = "running"
+        start = time.perf_counter()
+        client = shared.client(trial.seed, handler.checkpoint_dir)
+        client.begin()
+        try:
+            handler.run(pool=client, reporters=[FitnessCurve(self, trial)])
+            trial.status = "finished"
+        except TrialPruned:
+            trial.status = "pruned"
+        except Exception as e:
+            # A failed trial is reported in the summary, the others keep running
+            trial.status = "failed"
+            trial.error = repr(e)
+        finally:
+            client.pause()
+        trial.seconds = time.perf_counter() - start
+        print(f"Trial {trial.index} {trial.status} after {len(trial.curve)} generations, best fitness {trial.best()}")
+        self.write_summary()
+
+    def hopeless(self, trial):
+        # Median stopping rule: from min_generations on, a trial whose best fitness so far is below the median of
+        # the other trials at the same generation gives its share of the pool to the rest
+        generation = len(trial.curve)
+        if generation < self.min_generations:
+            return False
+        with self.lock:
+            others = [other.curve[generation - 1] for other in self.trials if other is not trial and len(other.curve) >= generation]
+        return len(others) >= self.min_trials and trial.curve[-1] < statistics.median(others)
+
+    def write_summary(self):
+        names = list(self.trials[0].params) if self.trials else []
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self.summary_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["trial", "seed", "status", "generations", "best_fitness", "seconds"] + names + ["error"])
+                for trial in self.trials:
+                    writer.writerow([trial.index, trial.seed, trial.status, len(trial.curve), trial.best(), round(trial.seconds, 1)] + [trial.params[name] for name in names] + [trial.error or ""])
+            os.replace(tmp_path, self.summary_path)
+
+    def print_summary(self):
+        names = list(self.trials[0].params) if self.trials else []
+        ranked = sorted(self.trials, key=lambda trial: -trial.best() if trial.best() is not None else float("inf"))
+        print(f"\n{'trial':>5} {'status':>8} {'gens':>4} {'best':>10} {'minutes':>7}  " + "  ".join(names))
+        for trial in ranked:
+            best = f"{trial.best():10.1f}" if trial.best() is not None else f"{'-':>10}"
+            print(f"{trial.index:>5} {trial.status:>8} {len(trial.curve):>4} {best} {trial.seconds / 60:7.1f}  " + "  ".join(str(trial.params[name]) for name in names))
+        print(f"Summary saved to {self.summary_path}")
+
+
+if __name__ == "__main__":
+    # python sweep.py [spec file] [output directory], see sweep.json for the spec format
+    Sweep(sys.argv[1] if len(sys.argv) > 1 else "sweep.json", sys.argv[2] if len(sys.argv) > 2 else "sweep").run()
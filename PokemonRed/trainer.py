@@ -1,47 +1,104 @@
+import os
 import random
 from pyboy import PyBoy
 from memory_addresses import *
-from skimage.transform import downscale_local_mean
+from observation_buffer import ObservationBuffer
+from action_trace import ActionTrace
+from exploration_map import ExplorationMap
+from ram_snapshot import RamSchema, Byte, Bytes, Words, Bcd, BitCount, Tiles
 import numpy as np
 
+# Everything read from RAM each step, fetched in one pass into a single buffer
+STATE_SCHEMA = RamSchema(
+    x_pos=Byte(X_POS_ADDRESS),
+    y_pos=Byte(Y_POS_ADDRESS),
+    map_n=Byte(MAP_N_ADDRESS),
+    battle_flag=Byte(BATTLE_FLAG_ADDRESS),
+    badges=Byte(BADGE_COUNT_ADDRESS),
+    party_size=Byte(PARTY_SIZE_ADDRESS),
+    levels=Bytes(*LEVELS_ADDRESSES),
+    hp=Words(*HP_ADDRESSES),
+    max_hp=Words(*MAX_HP_ADDRESSES),
+    money=Bcd(MONEY_ADDRESS_1, MONEY_ADDRESS_2, MONEY_ADDRESS_3),
+    event_flags=BitCount(EVENT_FLAGS_START_ADDRESS, EVENT_FLAGS_END_ADDRESS),
+)
+
+# What the stuck detector hashes after every decision, the tiles on screen (map, menus, text boxes) and the position
+STUCK_SCHEMA = RamSchema(
+    screen=Tiles(TILE_MAP_ADDRESS, TILE_MAP_ROWS, TILE_MAP_COLS, stride=TILE_MAP_COLS),
+    x_pos=Byte(X_POS_ADDRESS),
+    y_pos=Byte(Y_POS_ADDRESS),
+    map_n=Byte(MAP_N_ADDRESS),
+)
+
 class Trainer:
     
-    def __init__(self, pyboy: PyBoy, net, genome):
+    def __init__(self, pyboy: PyBoy, net, genome, frame_skip, exploration=None, encoder=None, seed=None, stuck=None):
         self.pyboy = pyboy
+        self.frame_skip = frame_skip
         self.net = net
         self.genome = genome
         self.actions = ['','a', 'b', 'left', 'right', 'up', 'down', 'start', 'select']
         self.rewards = {'seen_coord': 1, 'battle_win': 10, 'battle_lose': -10, 'badge_obtained': 1000}
-        self.seen_coords = {}
+        # Visit counts per map tile, handed in by the emulator handler so it can be reused between episodes
+        self.exploration = exploration if exploration is not None else ExplorationMap()
         self.last_coords_before_battle = None
-        self.wait_for_action = 150
         self.steps_without_reward = 2000
         self.current_steps_without_reward = 0
         self.max_recent_actions = 5
-        self.recent_actions = [random.randint(0, 8) for _ in range(self.max_recent_actions)]
-        self.recent_screens = np.zeros((72, 80, 3), dtype=np.uint8)
-        self.all_actions = []
+        # A fixed seed makes every episode start from the same history, so a genome's fitness is reproducible
+        rng = random.Random(seed) if seed is not None else random
+        self.recent_actions = [rng.randint(0, 8) for _ in range(self.max_recent_actions)]
+        # Coordinates and battle flag, recent actions, badges, then 3 stacked 72x80 screens
+        self.observation = ObservationBuffer(self.max_recent_actions + 5, 4, self.recent_actions, stack_size=3, scale_factor=2)
+        self.trace = ActionTrace()
+        self.current_state = None
+        # Optional fixed projection of the screens down to the network's num_inputs
+        self.encoder = encoder
+        self.ram = STATE_SCHEMA.snapshot(pyboy)
+        self.ram_stale = True
+        # How often each reward was given this episode, reported with the episode stats
+        self.reward_counts = dict.fromkeys(self.rewards, 0)
+        # Optional StuckDetector of the emulator handler, reset by it between episodes
+        self.stuck = stuck
+        self.stuck_ram = STUCK_SCHEMA.snapshot(pyboy) if stuck is not None else None
     
     def reward_function(self, action, state, next_state):
         final_reward = 0
         
         if not state['same_coords'] or not next_state['same_coords']:
+            self.reward_counts['seen_coord'] += 1
             final_reward += self.rewards['seen_coord']
             
         # Check if the player has won or lost a battle
         if state['battle_flag'] == 1 and next_state['battle_flag'] == 0:
             # Battle finished, check if the player won or lost
-            if self.last_coords_before_battle == next_state['coords_string']:
+            if self.last_coords_before_battle == next_state['coords']:
+                self.reward_counts['battle_win'] += 1
                 final_reward += self.rewards['battle_win']
             else:
+                self.reward_counts['battle_lose'] += 1
                 final_reward += self.rewards['battle_lose']
         
         return final_reward
             
     def step(self):
+        observation = self.begin_step()
+        return self.end_step(self.net.activate(observation))
+    
+    def begin_step(self):
+        
+        # Read the state and build the observation, the network runs between begin_step and end_step
+        self.current_state = self.get_state()
+        observation = self.get_observation(self.current_state)
+        if self.encoder is not None:
+            return self.encoder.encode(observation)
+        return observation
+    
+    def end_step(self, result):
         
-        current_state = self.get_state()
-        action = self.perform_action(current_state)
+        current_state = self.current_state
+        action = self.perform_action(result)
             
         next_state = self.get_state()
         reward = self.reward_function(action, current_state, next_state)
@@ -53,78 +110,82 @@ class Trainer:
             
         if self.current_steps_without_reward > self.steps_without_reward:
             return True, reward
+
+        # Menus, text boxes and walls repeat the same state long before steps_without_reward runs out
+        if self.stuck is not None and self.stuck.update(self.stuck_ram.read().data):
+            reward += self.stuck.penalty
+            return self.stuck.terminate, reward
         
         return False, reward
     
     def get_state(self):
         
         # Get player position
-        same_coords, coords_string = self.check_seen_coords()
+        self.read_ram()
+        same_coords, coords = self.check_seen_coords()
+
+        return {"same_coords": same_coords, "coords": coords, "battle_flag": self.ram["battle_flag"],
+                "money": self.ram["money"], "event_flags": self.ram["event_flags"], "hp": self.ram["hp"]}
 
-        return {"same_coords": same_coords, "coords_string": coords_string, "battle_flag": self.pyboy.memory[BATTLE_FLAG_ADDRESS]}
+    def read_ram(self):
+        # RAM only changes when the emulator runs, so one read per action is enough
+        if self.ram_stale:
+            self.ram.read()
+            self.ram_stale = False
     
-    def perform_action(self, current_state):
-        # Perform action and wait for 1200 ticks
-        action = self.get_action(current_state)
+    def perform_action(self, result):
+        # Perform action and let the frame skip run until the next decision
+        action = self.get_action(result)
 
         if action != '':
             self.pyboy.button(action)
-        self.pyboy.tick(self.wait_for_action)
+        self.frame_skip.advance()
+        self.ram_stale = True
         return action
     
-    def get_action(self, current_state):
-        
-        # Add observation to input
-        observation = self.get_observation(current_state)
-        
-        result = self.net.activate(observation)
+    def get_action(self, result):
         
-        action_index = result.index(max(result))
-        self.recent_actions.append(action_index)
-        self.all_actions.append(self.actions[action_index])
-
-        if len(self.recent_actions) > self.max_recent_actions:
-            self.recent_actions.pop(0)
+        action_index = int(np.argmax(result))
+        self.observation.push_action(action_index)
+        self.trace.append(action_index)
             
         return self.actions[action_index]
     
     def get_observation(self, current_state):
         x_pos, y_pos, map_n = self.get_game_coords()
-        current_badges = self.pyboy.memory[BADGE_COUNT_ADDRESS]
-        screen = self.render()
-        self.update_recent_screens(screen)
         
-        # Flatten and normalize the screen data
-        flattened_screens = self.recent_screens.flatten() / 255.0
+        # Write the scalar values and the newest screen straight into the observation buffer
+        scalars = self.observation.scalars
+        scalars[0] = x_pos
+        scalars[1] = y_pos
+        scalars[2] = map_n
+        scalars[3] = current_state['battle_flag']
+        scalars[-1] = self.ram["badges"]
+        self.observation.push_screen(self.get_screen())
         
-        # Return scalar values and flattened screen data
-        return [x_pos, y_pos, map_n, current_state['battle_flag']] + self.recent_actions + [current_badges] + flattened_screens.tolist()
-    
-    def update_recent_screens(self, cur_screen):
-        self.recent_screens = np.roll(self.recent_screens, 1, axis=2)
-        self.recent_screens[:, :, 0] = cur_screen[:,:, 0]
+        return self.observation.vector
+
+    def get_screen(self):
+        return self.pyboy.screen.ndarray
     
+    def behaviour(self):
+        # Where the episode ended, and how many maps and tiles it went through
+        x_pos, y_pos, map_n = self.get_game_coords()
+        return [map_n, x_pos, y_pos, len(self.exploration.maps()), len(self.exploration)]
+
     # Get the current player coordinates
     def get_game_coords(self):
-        return (self.pyboy.memory[X_POS_ADDRESS], self.pyboy.memory[Y_POS_ADDRESS], self.pyboy.memory[MAP_N_ADDRESS])
+        self.read_ram()
+        return (self.ram["x_pos"], self.ram["y_pos"], self.ram["map_n"])
     
     # Reward for checking a new coordinate
     def check_seen_coords(self):
-        if self.pyboy.memory[BATTLE_FLAG_ADDRESS] == 0:
-            coord_string = self.get_coords_string()
-            self.last_coords_before_battle = coord_string
-            if coord_string in self.seen_coords.keys():
-                self.seen_coords[coord_string] += 1
-                return True, coord_string
-            else:
-                self.seen_coords[coord_string] = 1
-                return False, coord_string  
+        if self.ram["battle_flag"] == 0:
+            coords = ExplorationMap.index(*self.get_game_coords())
+            self.last_coords_before_battle = coords
+            return not self.exploration.visit(coords), coords
         return True, None
     
-    def get_coords_string(self):
-        x_pos, y_pos, map_n = self.get_game_coords()
-        return f"x:{x_pos} y:{y_pos} m:{map_n}"
-    
     def manual_inputs(self):
         command = input("Enter command (one of: a, b, left, right, up, down, start, select): ")
         if command and command in self.actions:
@@ -133,16 +194,12 @@ class Trainer:
         else:
             print("Invalid input")
             
-    def save_actions(self, final_reward):
+    def save_actions(self, final_reward, header, trace_dir="checkpoints"):
+        # Path of the saved trace, None when the episode was not worth keeping
         if final_reward > 1:
-            with open(f"checkpoints/{self.genome.key}_actions.txt", "w") as f:
-                for action in self.all_actions:
-                    f.write(action + "\n")
-    
-    def render(self, reduce_res=True):
-        game_pixels_render = self.pyboy.screen.ndarray[:,:,0:1]
-        if reduce_res:
-            game_pixels_render = (
-                downscale_local_mean(game_pixels_render, (2,2,1))
-            ).astype(np.uint8)
-        return game_pixels_render
+            self.trace.header = dict(header, genome_key=self.genome.key, fitness=final_reward, actions=self.actions)
+            path = os.path.join(trace_dir, f"{self.genome.key}_actions.trace")
+            os.makedirs(trace_dir, exist_ok=True)
+            self.trace.save(path)
+            return path
+        return None
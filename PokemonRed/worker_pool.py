@@ -0,0 +1,224 @@
+from multiprocessing import Process, Queue, cpu_count, resource_tracker, shared_memory
+from queue import Empty
+from batch_evaluator import BatchEvaluator
+from compiled_network import CompiledNetwork
+from shared_networks import write_network, read_network, results_block, results_view
+import math
+import os
+import threading
+import weakref
+
+# A genome is not played again once its episodes took down this many workers
+MAX_ATTEMPTS = 2
+
+
+def worker_loop(game_path, state_path, state, config, batch_size, profile_every, encoder, seed, budget, stuck, wait_for_action, trace_dir, task_queue, result_queue):
+    # Each worker boots its emulators once and reuses them for every batch of genomes it receives
+    evaluator = BatchEvaluator(game_path, state_path, state, config, batch_size, profile_every, encoder, seed, budget, stuck, wait_for_action, trace_dir)
+
+    # Results blocks stay mapped for the whole run, a network block until nothing refers to its network anymore
+    results = {}
+    networks = {}
+
+    # A worker whose parent was killed, e.g. a lost worker daemon, exits instead of holding its sockets
+    parent = os.getppid()
+    while True:
+        try:
+            task = task_queue.get(timeout=1)
+        except Empty:
+            if os.getppid() != parent:
+                break
+            continue
+        if task is None:
+            break
+
+        jobs = []
+        slots = {}
+        for results_name, row, genome_key, network_name in task:
+            if results_name not in results:
+                block = shared_memory.SharedMemory(results_name)
+                results[results_name] = (block, results_view(block))
+            results[results_name][1]["owner"][row] = os.getpid()
+            block = shared_memory.SharedMemory(network_name)
+            net = read_network(block.buf)
+            networks[network_name] = (block, weakref.ref(net))
+            jobs.append((genome_key, net))
+            slots[genome_key] = (results_name, row)
+        net = None
+
+        for genome_key, fitness, stats in evaluator.evaluate(jobs):
+            results_name, row = slots[genome_key]
+            results[results_name][1]["fitness"][row] = fitness
+            result_queue.put((results_name, row, genome_key, stats))
+        jobs = None
+
+        # Views of a network have to be gone before its block can be unmapped
+        for name, (block, ref) in list(networks.items()):
+            if ref() is None:
+                block.close()
+                del networks[name]
+
+    evaluator.stop()
+
+
+class WorkerPool:
+
+    def __init__(self, game_path, state_path, config, num_workers=None, batch_size=1, profile_every=0, encoder=None, seed=None, budget=None, stuck=None, wait_for_action=150, trace_dir="checkpoints"):
+        self.game_path = game_path
+        self.state_path = state_path
+        self.config = config
+        self.num_workers = num_workers or cpu_count()
+        self.batch_size = batch_size
+        self.profile_every = profile_every
+        self.encoder = encoder
+        self.seed = seed
+        self.budget = budget
+        self.stuck = stuck
+        # Frames between decisions of every emulator
+        self.wait_for_action = wait_for_action
+        # Where the emulators save the action traces of their episodes
+        self.trace_dir = trace_dir
+        self.task_queue = Queue()
+        self.result_queue = Queue()
+        self.workers = []
+        self.state = None
+        # Per-episode stats of the last evaluated generation, by genome key
+        self.stats = {}
+        # Results blocks by name, free genome slots and the jobs in flight by slot
+        self.results = {}
+        self.free = []
+        self.jobs = {}
+        # The worker daemon submits and collects from different threads
+        self.lock = threading.Lock()
+
+        # Read the start state once for the whole run
+        if self.state_path is not None:
+            with open(self.state_path, "rb") as f:
+                self.state = f.read()
+
+    def start(self):
+        # Workers report the blocks they map to the tracker of this process, which forgets them once they are unlinked here
+        resource_tracker.ensure_running()
+        for _ in range(self.num_workers):
+            self.workers.append(self.start_worker())
+
+    def start_worker(self):
+        p = Process(target=worker_loop, args=(self.game_path, self.state_path, self.state, self.config, self.batch_size, self.profile_every, self.encoder, self.seed, self.budget, self.stuck, self.wait_for_action, self.trace_dir, self.task_queue, self.result_queue), daemon=True)
+        p.start()
+        return p
+
+    def evaluate(self, genomes, expected_steps=None):
+        # Longest expected episodes go first so they never start last and hold up the generation
+        if expected_steps:
+            genomes = sorted(genomes, key=lambda item: -expected_steps.get(item[0], 0))
+
+        # With a quorum the episodes still running are cut off once enough of the generation is done
+        quorum = len(genomes)
+        if self.budget is not None:
+            self.budget.cutoff.value = 0
+            quorum = self.budget.quorum_size(len(genomes))
+
+        # Split the generation into batches so every worker gets a share
+        size = max(1, min(self.batch_size, math.ceil(len(genomes) / self.num_workers)))
+        for i in range(0, len(genomes), size):
+            self.submit(genomes[i:i + size])
+
+        fitnesses = {}
+        self.stats = {}
+        while len(fitnesses) < len(genomes):
+            for genome_key, fitness, stats in self.collect():
+                fitnesses[genome_key] = fitness
+                self.stats[genome_key] = stats
+                if len(fitnesses) == quorum and quorum < len(genomes):
+                    self.budget.cutoff.value = 1
+
+        return fitnesses
+
+    def submit(self, genomes):
+        # Networks are compiled once here and written to shared memory, a task only names the blocks.
+        # Each batch is queued as soon as it is written, so the workers start while the rest is compiled
+        task = []
+        for genome_key, genome in genomes:
+            block = write_network(CompiledNetwork.create(genome, self.config))
+            with self.lock:
+                slot = self.allocate()
+                self.jobs[slot] = [genome_key, block, 0]
+            task.append(slot + (genome_key, block.name))
+        self.task_queue.put(task)
+
+    def allocate(self):
+        if not self.free:
+            # Another results block once every slot is in flight, the workers keep the old ones mapped
+            block = results_block(max(self.config.pop_size, self.num_workers * self.batch_size))
+            self.results[block.name] = (block, results_view(block))
+            self.free = [(block.name, row) for row in reversed(range(len(self.results[block.name][1])))]
+        results_name, row = slot = self.free.pop()
+        self.results[results_name][1]["owner"][row] = 0
+        return slot
+
+    def collect(self, timeout=1):
+        # Episodes finished since the last call as (genome key, fitness, stats), the fitness is read from its slot
+        try:
+            messages = [self.result_queue.get(timeout=timeout)]
+        except Empty:
+            self.check_workers()
+            return []
+        while True:
+            try:
+                messages.append(self.result_queue.get_nowait())
+            except Empty:
+                break
+
+        finished = []
+        with self.lock:
+            for results_name, row, genome_key, stats in messages:
+                slot = (results_name, row)
+                job = self.jobs.pop(slot, None)
+                if job is None:
+                    # Result of a dead worker that arrived after its genome was handed out again
+                    continue
+                job[1].close()
+                job[1].unlink()
+                self.free.append(slot)
+                finished.append((genome_key, float(self.results[results_name][1]["fitness"][row]), stats))
+        return finished
+
+    def check_workers(self):
+        # A worker that died during an episode is replaced and its genomes are played again on fresh slots,
+        # so a late result of the dead worker can never land in a slot that was reused
+        for i, p in enumerate(self.workers):
+            if p.is_alive():
+                continue
+            with self.lock:
+                lost = [slot for slot in self.jobs if self.results[slot[0]][1]["owner"][slot[1]] == p.pid]
+                if not lost:
+                    raise RuntimeError(f"Worker {p.pid} exited with code {p.exitcode}")
+                task = []
+                for slot in lost:
+                    job = self.jobs.pop(slot)
+                    job[2] += 1
+                    if job[2] >= MAX_ATTEMPTS:
+                        raise RuntimeError(f"Genome {job[0]} took down {job[2]} workers, last exit code {p.exitcode}")
+                    new_slot = self.allocate()
+                    self.jobs[new_slot] = job
+                    task.append(new_slot + (job[0], job[1].name))
+            print(f"Worker {p.pid} exited with code {p.exitcode}, playing its {len(task)} genomes again")
+            self.task_queue.put(task)
+            self.workers[i] = self.start_worker()
+
+    def stop(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for p in self.workers:
+            p.join()
+        self.workers = []
+
+        for _, block, _ in self.jobs.values():
+            block.close()
+            block.unlink()
+        self.jobs = {}
+        for name in list(self.results):
+            block = self.results.pop(name)[0]
+            block.close()
+            block.unlink()
+        self.free = []
@@ -0,0 +1,454 @@
+from neat.genome import DefaultGenome, DefaultGenomeConfig
+from neat.genes import BaseGene, DefaultNodeGene, DefaultConnectionGene
+from collections.abc import MutableMapping
+from random import random, choice, randrange, getrandbits
+from fast_species import pack_keys
+import configparser
+import numpy as np
+
+
+class ArrayNodeGene:
+    # DefaultNodeGene without a __dict__, genomes of large networks hold many of them
+    __slots__ = ("key", "bias", "response", "activation", "aggregation")
+    _gene_attributes = DefaultNodeGene._gene_attributes
+
+    def __init__(self, key):
+        assert isinstance(key, int), "ArrayNodeGene key must be an int, not {!r}".format(key)
+        self.key = key
+
+    # The gene logic only goes through getattr and setattr, so neat's own is reused
+    get_config_params = classmethod(BaseGene.get_config_params.__func__)
+    parse_config = classmethod(BaseGene.parse_config.__func__)
+    init_attributes = BaseGene.init_attributes
+    mutate = BaseGene.mutate
+    copy = BaseGene.copy
+    crossover = BaseGene.crossover
+    distance = DefaultNodeGene.distance
+    __str__ = BaseGene.__str__
+    __lt__ = BaseGene.__lt__
+
+
+class ConnectionGene:
+    # One row of an ArrayGenome seen as a DefaultConnectionGene, for code that walks genome.connections
+    __slots__ = ("genome", "row")
+
+    def __init__(self, genome, row):
+        self.genome = genome
+        self.row = row
+
+    @property
+    def key(self):
+        return int(self.genome.sources[self.row]), int(self.genome.targets[self.row])
+
+    @property
+    def weight(self):
+        return float(self.genome.weights[self.row])
+
+    @weight.setter
+    def weight(self, value):
+        self.genome.weights[self.row] = value
+
+    @property
+    def enabled(self):
+        return bool(self.genome.enabled[self.row])
+
+    @enabled.setter
+    def enabled(self, value):
+        self.genome.enabled[self.row] = value
+
+    distance = DefaultConnectionGene.distance
+    __lt__ = BaseGene.__lt__
+
+    def copy(self):
+        gene = DefaultConnectionGene(self.key)
+        gene.weight = self.weight
+        gene.enabled = self.enabled
+        return gene
+
+    def __str__(self):
+        return f"DefaultConnectionGene(key={self.key}, weight={self.weight}, enabled={self.enabled})"
+
+
+class ConnectionGenes(MutableMapping):
+    # genome.connections of an ArrayGenome, a dict of (in, out) keys to genes in row order
+
+    def __init__(self, genome):
+        self.genome = genome
+
+    def __len__(self):
+        return len(self.genome.weights)
+
+    def __iter__(self):
+        return zip(self.genome.sources.tolist(), self.genome.targets.tolist())
+
+    def __getitem__(self, key):
+        row = self.genome.find(*key)
+        if row is None:
+            raise KeyError(key)
+        return ConnectionGene(self.genome, row)
+
+    def __setitem__(self, key, gene):
+        self.genome.set_connection(key, gene.weight, gene.enabled)
+
+    def __delitem__(self, key):
+        row = self.genome.find(*key)
+        if row is None:
+            raise KeyError(key)
+        keep = np.ones(len(self), dtype=bool)
+        keep[row] = False
+        self.genome.keep_connections(keep)
+
+    def values(self):
+        return [ConnectionGene(self.genome, row) for row in range(len(self))]
+
+    def items(self):
+        return list(zip(self, self.values()))
+
+
+def attribute_rng():
+    # Drawn from the random module, so seeding it and the checkpointed random state cover these draws too
+    return np.random.default_rng(getrandbits(64))
+
+
+def init_floats(config, name, count, rng):
+    # FloatAttribute.init_value for count genes at once
+    mean = getattr(config, f"{name}_init_mean")
+    stdev = getattr(config, f"{name}_init_stdev")
+    min_value = getattr(config, f"{name}_min_value")
+    max_value = getattr(config, f"{name}_max_value")
+    init_type = getattr(config, f"{name}_init_type").lower()
+    if "gauss" in init_type or "normal" in init_type:
+        return np.clip(rng.normal(mean, stdev, count), min_value, max_value)
+    if "uniform" in init_type:
+        return rng.uniform(max(min_value, mean - 2 * stdev), min(max_value, mean + 2 * stdev), count)
+    raise RuntimeError("Unknown init_type {!r} for {!s}".format(init_type, f"{name}_init_type"))
+
+
+def mutate_floats(values, config, name, rng):
+    # FloatAttribute.mutate_value in place, one draw per gene decides between perturbing and replacing
+    mutate_rate = getattr(config, f"{name}_mutate_rate")
+    replace_rate = getattr(config, f"{name}_replace_rate")
+    r = rng.random(len(values))
+    mutated = r < mutate_rate
+    perturbed = values[mutated] + rng.normal(0.0, getattr(config, f"{name}_mutate_power"), np.count_nonzero(mutated))
+    values[mutated] = np.clip(perturbed, getattr(config, f"{name}_min_value"), getattr(config, f"{name}_max_value"))
+    replaced = ~mutated & (r < mutate_rate + replace_rate)
+    values[replaced] = init_floats(config, name, np.count_nonzero(replaced), rng)
+
+
+def init_bools(config, name, count, rng):
+    default = str(getattr(config, f"{name}_default")).lower()
+    if default in ("1", "on", "yes", "true"):
+        return np.ones(count, dtype=bool)
+    if default in ("0", "off", "no", "false"):
+        return np.zeros(count, dtype=bool)
+    if default in ("random", "none"):
+        return rng.random(count) < 0.5
+    raise RuntimeError("Unknown default value {!r} for {!s}".format(default, name))
+
+
+def mutate_bools(values, config, name, rng):
+    # BoolAttribute.mutate_value in place, a mutated gene gets a random value
+    mutate_rate = getattr(config, f"{name}_mutate_rate")
+    rate = np.where(values, mutate_rate + getattr(config, f"{name}_rate_to_false_add"), mutate_rate + getattr(config, f"{name}_rate_to_true_add"))
+    flipped = rng.random(len(values)) < rate
+    values[flipped] = rng.random(np.count_nonzero(flipped)) < 0.5
+
+
+def homologous(genome, other):
+    # Mask of the connections of genome that other has too, and their rows in other
+    keys = pack_keys(genome.sources, genome.targets)
+    if len(other.weights) == 0:
+        return np.zeros(len(keys), dtype=bool), np.zeros(0, dtype=np.int64)
+    other_keys = pack_keys(other.sources, other.targets)
+    order = np.argsort(other_keys)
+    other_sorted = other_keys[order]
+    index = np.minimum(np.searchsorted(other_sorted, keys), len(other_sorted) - 1)
+    found = other_sorted[index] == keys
+    return found, order[index[found]]
+
+
+class ArrayGenome(DefaultGenome):
+    # DefaultGenome with the connection genes as parallel arrays in dict order, mutated and crossed over at once.
+    # Nodes stay a dict of genes, there are few of them
+
+    @staticmethod
+    def select(config_file):
+        # The genome type is picked by the section name in the NEAT config file
+        parser = configparser.ConfigParser()
+        parser.read(config_file)
+        return ArrayGenome if parser.has_section("ArrayGenome") else DefaultGenome
+
+    @classmethod
+    def parse_config(cls, param_dict):
+        param_dict['node_gene_type'] = ArrayNodeGene
+        param_dict['connection_gene_type'] = DefaultConnectionGene
+        return DefaultGenomeConfig(param_dict)
+
+    def __init__(self, key):
+        self.key = key
+        self.nodes = {}
+        self.set_connections(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64), np.zeros(0, dtype=bool))
+        self.fitness = None
+
+    @property
+    def connections(self):
+        return ConnectionGenes(self)
+
+    def set_connections(self, sources, targets, weights, enabled):
+        # Takes ownership of the arrays
+        self.sources = np.asarray(sources, dtype=np.int32)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.enabled = np.asarray(enabled, dtype=bool)
+
+    def append_connections(self, sources, targets, weights, enabled):
+        self.set_connections(np.concatenate([self.sources, np.asarray(sources, dtype=np.int32)]), np.concatenate([self.targets, np.asarray(targets, dtype=np.int32)]),
+                             np.concatenate([self.weights, np.asarray(weights, dtype=np.float64)]), np.concatenate([self.enabled, np.asarray(enabled, dtype=bool)]))
+
+    def keep_connections(self, mask):
+        self.set_connections(self.sources[mask], self.targets[mask], self.weights[mask], self.enabled[mask])
+
+    def find(self, input_key, output_key):
+        rows = np.flatnonzero((self.sources == input_key) & (self.targets == output_key))
+        return int(rows[0]) if len(rows) else None
+
+    def set_connection(self, key, weight, enabled):
+        # A known key keeps its row, like assigning to a dict
+        row = self.find(*key)
+        if row is None:
+            self.append_connections([key[0]], [key[1]], [weight], [enabled])
+        else:
+            self.weights[row] = weight
+            self.enabled[row] = enabled
+
+    def expressed_connections(self):
+        # (in, out, weight) arrays of the enabled connections, what CompiledNetwork needs
+        enabled = self.enabled
+        return self.sources[enabled].astype(np.int64), self.targets[enabled].astype(np.int64), self.weights[enabled]
+
+    def new_connections(self, config, sources, targets):
+        rng = attribute_rng()
+        self.append_connections(sources, targets, init_floats(config, "weight", len(sources), rng), init_bools(config, "enabled", len(sources), rng))
+
+    def configure_crossover(self, genome1, genome2, config):
+        assert isinstance(genome1.fitness, (int, float))
+        assert isinstance(genome2.fitness, (int, float))
+        if genome1.fitness > genome2.fitness:
+            parent1, parent2 = genome1, genome2
+        else:
+            parent1, parent2 = genome2, genome1
+
+        # Connections of the fitter parent, every attribute of a homologous gene from either parent at random
+        rng = attribute_rng()
+        found, match = homologous(parent1, parent2)
+        rows = np.flatnonzero(found)
+        weights = parent1.weights.copy()
+        enabled = parent1.enabled.copy()
+        other = rng.random(len(rows)) <= 0.5
+        weights[rows[other]] = parent2.weights[match[other]]
+        other = rng.random(len(rows)) <= 0.5
+        enabled[rows[other]] = parent2.enabled[match[other]]
+        self.set_connections(parent1.sources.copy(), parent1.targets.copy(), weights, enabled)
+
+        for key, ng1 in parent1.nodes.items():
+            ng2 = parent2.nodes.get(key)
+            assert key not in self.nodes
+            if ng2 is None:
+                self.nodes[key] = ng1.copy()
+            else:
+                self.nodes[key] = ng1.crossover(ng2)
+
+    def mutate(self, config):
+        # Structural mutations exactly as DefaultGenome.mutate, then all connection attributes at once
+        if config.single_structural_mutation:
+            div = max(1, (config.node_add_prob + config.node_delete_prob + config.conn_add_prob + config.conn_delete_prob))
+            r = random()
+            if r < (config.node_add_prob / div):
+                self.mutate_add_node(config)
+            elif r < ((config.node_add_prob + config.node_delete_prob) / div):
+                self.mutate_delete_node(config)
+            elif r < ((config.node_add_prob + config.node_delete_prob + config.conn_add_prob) / div):
+                self.mutate_add_connection(config)
+            elif r < ((config.node_add_prob + config.node_delete_prob + config.conn_add_prob + config.conn_delete_prob) / div):
+                self.mutate_delete_connection()
+        else:
+            if random() < config.node_add_prob:
+                self.mutate_add_node(config)
+
+            if random() < config.node_delete_prob:
+                self.mutate_delete_node(config)
+
+            if random() < config.conn_add_prob:
+                self.mutate_add_connection(config)
+
+            if random() < config.conn_delete_prob:
+                self.mutate_delete_connection()
+
+        rng = attribute_rng()
+        mutate_floats(self.weights, config, "weight", rng)
+        mutate_bools(self.enabled, config, "enabled", rng)
+
+        for ng in self.nodes.values():
+            ng.mutate(config)
+
+    def mutate_add_node(self, config):
+        if not len(self.weights):
+            if config.check_structural_mutation_surer():
+                self.mutate_add_connection(config)
+            return
+
+        # Split a random connection, the new node and connections behave roughly like the old connection
+        row = randrange(len(self.weights))
+        new_node_id = config.get_new_node_key(self.nodes)
+        self.nodes[new_node_id] = self.create_node(config, new_node_id)
+        self.enabled[row] = False
+        i, o, weight = int(self.sources[row]), int(self.targets[row]), float(self.weights[row])
+        self.add_connection(config, i, new_node_id, 1.0, True)
+        self.add_connection(config, new_node_id, o, weight, True)
+
+    def add_connection(self, config, input_key, output_key, weight, enabled):
+        assert isinstance(input_key, int)
+        assert isinstance(output_key, int)
+        assert output_key >= 0
+        assert isinstance(enabled, bool)
+        self.set_connection((input_key, output_key), weight, enabled)
+
+    def mutate_add_connection(self, config):
+        possible_outputs = list(self.nodes)
+        out_node = choice(possible_outputs)
+        in_node = choice(possible_outputs + config.input_keys)
+
+        # Don't duplicate connections
+        row = self.find(in_node, out_node)
+        if row is not None:
+            if config.check_structural_mutation_surer():
+                self.enabled[row] = True
+            return
+
+        # Don't allow connections between two output nodes
+        if in_node in config.output_keys and out_node in config.output_keys:
+            return
+
+        # For feed-forward networks, avoid creating cycles
+        if config.feed_forward and self.creates_cycle(in_node, out_node):
+            return
+
+        cg = self.create_connection(config, in_node, out_node)
+        self.append_connections([in_node], [out_node], [cg.weight], [cg.enabled])
+
+    def creates_cycle(self, input_key, output_key):
+        # neat.graphs.creates_cycle, following every connection out of the reached nodes at once
+        if input_key == output_key:
+            return True
+        visited = np.array([output_key])
+        frontier = visited
+        while len(frontier):
+            reached = np.unique(self.targets[np.isin(self.sources, frontier)])
+            if np.any(reached == input_key):
+                return True
+            frontier = reached[~np.isin(reached, visited)]
+            visited = np.concatenate([visited, frontier])
+        return False
+
+    def mutate_delete_node(self, config):
+        # Do nothing if there are no non-output nodes
+        available_nodes = [k for k in self.nodes if k not in config.output_keys]
+        if not available_nodes:
+            return -1
+
+        del_key = choice(available_nodes)
+        self.keep_connections((self.sources != del_key) & (self.targets != del_key))
+        del self.nodes[del_key]
+        return del_key
+
+    def mutate_delete_connection(self):
+        if len(self.weights):
+            keep = np.ones(len(self.weights), dtype=bool)
+            keep[randrange(len(self.weights))] = False
+            self.keep_connections(keep)
+
+    def distance(self, other, config):
+        # Same formula as DefaultGenome.distance, the connection part over the arrays
+        node_distance = 0.0
+        if self.nodes or other.nodes:
+            disjoint_nodes = sum(1 for k2 in other.nodes if k2 not in self.nodes)
+            for k1, n1 in self.nodes.items():
+                n2 = other.nodes.get(k1)
+                if n2 is None:
+                    disjoint_nodes += 1
+                else:
+                    node_distance += n1.distance(n2, config)
+            max_nodes = max(len(self.nodes), len(other.nodes))
+            node_distance = (node_distance + (config.compatibility_disjoint_coefficient * disjoint_nodes)) / max_nodes
+
+        connection_distance = 0.0
+        if len(self.weights) or len(other.weights):
+            found, match = homologous(self, other)
+            d = np.abs(self.weights[found] - other.weights[match]) + (self.enabled[found] != other.enabled[match])
+            disjoint_connections = len(self.weights) + len(other.weights) - 2 * len(match)
+            max_conn = max(len(self.weights), len(other.weights))
+            connection_distance = (float(d.sum()) * config.compatibility_weight_coefficient + (config.compatibility_disjoint_coefficient * disjoint_connections)) / max_conn
+
+        return node_distance + connection_distance
+
+    def size(self):
+        return len(self.nodes), int(np.count_nonzero(self.enabled))
+
+    def __str__(self):
+        lines = ["Key: {0}\nFitness: {1}\nNodes:".format(self.key, self.fitness)]
+        lines += ["\t{0} {1!s}".format(k, ng) for k, ng in self.nodes.items()]
+        lines.append("Connections:")
+        lines += ["\t" + str(ConnectionGene(self, row)) for row in np.lexsort((self.targets, self.sources)).tolist()]
+        return "\n".join(lines)
+
+    def full_connections(self, config, direct):
+        # compute_full_connections as (in, out) arrays in the same order
+        hidden = np.array([i for i in self.nodes if i not in config.output_keys], dtype=np.int32)
+        output = np.array([i for i in self.nodes if i in config.output_keys], dtype=np.int32)
+        inputs = np.array(config.input_keys, dtype=np.int32)
+        sources, targets = [], []
+        if len(hidden):
+            sources += [np.repeat(inputs, len(hidden)), np.repeat(hidden, len(output))]
+            targets += [np.tile(hidden, len(inputs)), np.tile(output, len(hidden))]
+        if direct or not len(hidden):
+            sources.append(np.repeat(inputs, len(output)))
+            targets.append(np.tile(output, len(inputs)))
+
+        # For recurrent genomes, include node self-connections
+        if not config.feed_forward:
+            nodes = np.array(list(self.nodes), dtype=np.int32)
+            sources.append(nodes)
+            targets.append(nodes)
+
+        if not sources:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        return np.concatenate(sources), np.concatenate(targets)
+
+    def connect_fs_neat_nohidden(self, config):
+        input_id = choice(config.input_keys)
+        self.new_connections(config, [input_id] * len(config.output_keys), config.output_keys)
+
+    def connect_fs_neat_hidden(self, config):
+        input_id = choice(config.input_keys)
+        others = [i for i in self.nodes if i not in config.input_keys]
+        self.new_connections(config, [input_id] * len(others), others)
+
+    def connect_full_nodirect(self, config):
+        self.new_connections(config, *self.full_connections(config, False))
+
+    def connect_full_direct(self, config):
+        self.new_connections(config, *self.full_connections(config, True))
+
+    def connect_partial_nodirect(self, config):
+        self.connect_partial(config, False)
+
+    def connect_partial_direct(self, config):
+        self.connect_partial(config, True)
+
+    def connect_partial(self, config, direct):
+        assert 0 <= config.connection_fraction <= 1
+        sources, targets = self.full_connections(config, direct)
+        num_to_add = int(round(len(sources) * config.connection_fraction))
+        chosen = attribute_rng().permutation(len(sources))[:num_to_add]
+        self.new_connections(config, sources[chosen], targets[chosen])
@@ -0,0 +1,194 @@
+from observation_buffer import ObservationBuffer
+from pyboy_handler import PyBoyHandler
+from compiled_network import CompiledNetwork
+from fast_species import FastSpeciesSet
+from array_genome import ArrayGenome
+from player import Player
+from skimage.transform import downscale_local_mean
+import numpy as np
+import neat
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SCALE_FACTOR = 4
+MAX_RECENT_ACTIONS = 5
+
+GAME_PATH = "ROM/Tetris.gb"
+STATE_PATH = "ROM/states/game_start.state"
+CONFIG_FILE = "config-neat.txt"
+
+
+def legacy_observation(recent_screens, recent_actions, piece_position, screen):
+    # The original Player.get_observation pipeline
+    cur_screen = downscale_local_mean(screen[:, :, 0:1], (SCALE_FACTOR, SCALE_FACTOR, 1)).astype(np.uint8)
+    recent_screens = np.roll(recent_screens, 1, axis=2)
+    recent_screens[:, :, 0] = cur_screen[:, :, 0]
+    flattened_screens = recent_screens.flatten() / 255.0
+    return recent_screens, recent_actions + piece_position + flattened_screens.tolist()
+
+
+def measure(step, screens, repeats):
+    # Warm up once so lazily created buffers are not counted
+    step(screens[0])
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        step(screens[i % len(screens)])
+    seconds = (time.perf_counter() - start) / repeats
+
+    tracemalloc.start()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for i in range(repeats):
+        step(screens[i % len(screens)])
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"us_per_step": seconds * 1e6, "retained_bytes_per_step": (retained - current) / repeats, "peak_bytes": peak - current}
+
+
+def benchmark_observation(repeats=2000):
+    rng = np.random.default_rng(0)
+    screens = rng.integers(0, 256, (8, 144, 160, 4), dtype=np.uint8)
+    recent_actions = [0] * MAX_RECENT_ACTIONS
+    piece_position = [0, 0]
+
+    state = {"recent_screens": np.zeros((144 // SCALE_FACTOR, 160 // SCALE_FACTOR, 3), dtype=np.uint8)}
+    def legacy_step(screen):
+        state["recent_screens"], observation = legacy_observation(state["recent_screens"], recent_actions, piece_position, screen)
+
+    buffer = ObservationBuffer(MAX_RECENT_ACTIONS + 2, 0, recent_actions, stack_size=3, scale_factor=SCALE_FACTOR)
+    def buffer_step(screen):
+        buffer.push_screen(screen)
+        buffer.push_action(1)
+
+    return {"legacy": measure(legacy_step, screens, repeats), "buffer": measure(buffer_step, screens, repeats)}
+
+
+def synthetic_rom(path):
+    # Smallest cartridge PyBoy accepts: jump to an endless loop, with a valid header checksum
+    rom = bytearray(32768)
+    rom[0x100:0x104] = bytes([0x00, 0xC3, 0x50, 0x01])
+    rom[0x150:0x152] = bytes([0x18, 0xFE])
+    checksum = 0
+    for i in range(0x134, 0x14D):
+        checksum = (checksum - rom[i] - 1) & 0xFF
+    rom[0x14D] = checksum
+    with open(path, "wb") as f:
+        f.write(rom)
+    return path
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def wrap(self, owner, name, stage):
+        # Swap a method on one object for a timed version of it
+        method = getattr(owner, name)
+        self.seconds.setdefault(stage, 0.0)
+        self.calls.setdefault(stage, 0)
+
+        def timed(*args):
+            start = time.perf_counter()
+            result = method(*args)
+            self.seconds[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+            return result
+
+        setattr(owner, name, timed)
+
+
+def benchmark_step(decisions=500, seed=0, config_file=CONFIG_FILE):
+    # Run the real step loop headless with a fixed random genome, on a generated ROM when the game is missing
+    workdir = tempfile.mkdtemp()
+    game_path, state_path = GAME_PATH, STATE_PATH
+    synthetic = not os.path.exists(game_path)
+    if synthetic:
+        game_path = synthetic_rom(os.path.join(workdir, "synthetic.gb"))
+    if synthetic or not os.path.exists(state_path):
+        state_path = None
+
+    config = neat.Config(ArrayGenome.select(config_file), neat.DefaultReproduction, FastSpeciesSet.select(config_file), neat.DefaultStagnation, config_file)
+    random.seed(seed)
+    genome = config.genome_type(0)
+    genome.configure_new(config.genome_config)
+    net = CompiledNetwork.create(genome, config)
+
+    handler = PyBoyHandler(game_path, state_path, observation_mode=Player.observation_mode_for(config.genome_config.num_inputs))
+    timer = StageTimer()
+    timer.wrap(handler, "begin_episode", "episode reset")
+    timer.wrap(handler.frame_skip, "advance", "pyboy.tick")
+    timer.wrap(net, "activate", "net.activate")
+
+    done = 0
+    frames = 0
+    start = time.perf_counter()
+    while done < decisions:
+        handler.begin_episode(net, genome)
+        player = handler.player
+        timer.wrap(player, "get_screen", "screen capture")
+        timer.wrap(player.observation, "downscale", "downscale")
+        timer.wrap(player.observation, "stack_frame", "frame stacking")
+        timer.wrap(player.ram, "read", "memory reads")
+        timer.wrap(player, "reward_function", "reward")
+        if player.observation_mode == "features":
+            timer.wrap(player.board_features, "update", "board features")
+
+        first_frame = handler.pyboy.frame_count
+        while done < decisions:
+            observation = handler.observe()
+            if observation is None:
+                break
+            done += 1
+            if handler.act(net.activate(observation)):
+                break
+        frames += handler.pyboy.frame_count - first_frame
+    seconds = time.perf_counter() - start
+    handler.end_game()
+
+    stages = {}
+    for stage, stage_seconds in timer.seconds.items():
+        stages[stage] = {"calls": timer.calls[stage], "us_per_decision": stage_seconds / done * 1e6, "share": stage_seconds / seconds}
+    other = seconds - sum(timer.seconds.values())
+    stages["other"] = {"calls": done, "us_per_decision": other / done * 1e6, "share": other / seconds}
+
+    return {
+        "game": "Tetris",
+        "rom": "synthetic" if synthetic else game_path,
+        "num_inputs": config.genome_config.num_inputs,
+        "connections": genome.size()[1],
+        "decisions": done,
+        "frames": frames,
+        "seconds": seconds,
+        "frames_per_second": frames / seconds,
+        "decisions_per_second": done / seconds,
+        "stages": stages,
+    }
+
+
+if __name__ == "__main__":
+    # python benchmark.py [output.json] [config file], e.g. config-neat-features.txt for the board features
+    config_file = sys.argv[2] if len(sys.argv) > 2 else CONFIG_FILE
+    results = {"step": benchmark_step(config_file=config_file), "observation": benchmark_observation(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    step = results["step"]
+    print(f"{step['game']} on {step['rom']}: {step['frames_per_second']:.0f} frames/s, {step['decisions_per_second']:.1f} decisions/s")
+    for stage, result in sorted(step["stages"].items(), key=lambda item: -item[1]["share"]):
+        print(f"{stage:>15}: {result['us_per_decision']:10.1f} us/decision {100 * result['share']:6.1f}%")
+    for name, result in results["observation"].items():
+        print(f"{name:>8}: {result['us_per_step']:8.1f} us/step, {result['retained_bytes_per_step']:8.1f} B retained/step, {result['peak_bytes']:9d} B peak")
+
+    # Keep every run so results can be compared over time
+    path = sys.argv[1] if len(sys.argv) > 1 else f"benchmarks/benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved {path}")
@@ -0,0 +1,41 @@
+from memory_addresses import PLAYFIELD_ROWS, PLAYFIELD_COLS, BLANK_TILE
+import numpy as np
+
+
+class BoardFeatures:
+
+    # Column heights, then holes, bumpiness, complete lines, max height, piece id, rotation and next piece id
+    SIZE = PLAYFIELD_COLS + 7
+
+    def __init__(self, out):
+        self.out = out
+        self.heights = out[:PLAYFIELD_COLS]
+        self.occupied = np.zeros((PLAYFIELD_ROWS, PLAYFIELD_COLS), dtype=bool)
+        self.covered = np.zeros((PLAYFIELD_ROWS, PLAYFIELD_COLS), dtype=bool)
+        self.row_index = np.arange(PLAYFIELD_ROWS, 0, -1)[:, None]
+
+    def update(self, board, piece, next_piece):
+        # board is the playfield tile map, the falling piece is a sprite and not part of it
+        occupied = self.occupied
+        np.not_equal(board, BLANK_TILE, out=occupied)
+
+        # Height of a column is measured from the bottom to its highest block
+        np.max(occupied * self.row_index, axis=0, out=self.heights)
+
+        # Empty cells with a block somewhere above them
+        np.logical_or.accumulate(occupied, axis=0, out=self.covered)
+        holes = np.count_nonzero(self.covered) - np.count_nonzero(occupied)
+
+        out = self.out
+        out[PLAYFIELD_COLS] = holes
+        out[PLAYFIELD_COLS + 1] = np.abs(np.diff(self.heights)).sum()
+        out[PLAYFIELD_COLS + 2] = np.count_nonzero(occupied.all(axis=1))
+        out[PLAYFIELD_COLS + 3] = self.heights.max()
+        out[PLAYFIELD_COLS + 4] = piece >> 2
+        out[PLAYFIELD_COLS + 5] = piece & 3
+        out[PLAYFIELD_COLS + 6] = next_piece >> 2
+        return out
+
+    @staticmethod
+    def occupancy(board):
+        return board != BLANK_TILE
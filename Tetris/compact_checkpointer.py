@@ -0,0 +1,260 @@
+from neat.reporting import BaseReporter, ReporterSet
+from neat.species import Species
+from itertools import count
+import neat
+import numpy as np
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+
+MANIFEST_PATTERN = re.compile(r"checkpoint-(\d+)\.json$")
+
+
+def connection_arrays(genome):
+    # (in, out, weight, enabled) of a genome in dict order, an ArrayGenome already holds them like that
+    if hasattr(genome, "expressed_connections"):
+        return genome.sources, genome.targets, genome.weights, genome.enabled
+    connections = genome.connections
+    count = len(connections)
+    return (np.fromiter((key[0] for key in connections), dtype=np.int32, count=count),
+            np.fromiter((key[1] for key in connections), dtype=np.int32, count=count),
+            np.fromiter((gene.weight for gene in connections.values()), dtype=np.float64, count=count),
+            np.fromiter((gene.enabled for gene in connections.values()), dtype=bool, count=count))
+
+
+def pack_genomes(genomes):
+    # Genes of many genomes in flat arrays, in dict order so a restored genome iterates like the original
+    activations = {}
+    aggregations = {}
+    nodes = [node for genome in genomes for node in genome.nodes.values()]
+    connections = [connection_arrays(genome) for genome in genomes]
+    return {
+        "genome_keys": np.fromiter((genome.key for genome in genomes), dtype=np.int64, count=len(genomes)),
+        "node_counts": np.fromiter((len(genome.nodes) for genome in genomes), dtype=np.int64, count=len(genomes)),
+        "connection_counts": np.fromiter((len(genome.connections) for genome in genomes), dtype=np.int64, count=len(genomes)),
+        "node_keys": np.fromiter((node.key for node in nodes), dtype=np.int32, count=len(nodes)),
+        "bias": np.fromiter((node.bias for node in nodes), dtype=np.float64, count=len(nodes)),
+        "response": np.fromiter((node.response for node in nodes), dtype=np.float64, count=len(nodes)),
+        "activation": np.fromiter((activations.setdefault(node.activation, len(activations)) for node in nodes), dtype=np.uint8, count=len(nodes)),
+        "aggregation": np.fromiter((aggregations.setdefault(node.aggregation, len(aggregations)) for node in nodes), dtype=np.uint8, count=len(nodes)),
+        "activation_names": np.array(list(activations), dtype=str),
+        "aggregation_names": np.array(list(aggregations), dtype=str),
+        "connection_in": np.concatenate([arrays[0] for arrays in connections]).astype(np.int32),
+        "connection_out": np.concatenate([arrays[1] for arrays in connections]).astype(np.int32),
+        "weight": np.concatenate([arrays[2] for arrays in connections]).astype(np.float64),
+        "enabled": np.concatenate([arrays[3] for arrays in connections]).astype(bool),
+    }
+
+
+def unpack_genomes(data, config, wanted):
+    # Rebuild the genomes of one segment whose keys are in wanted
+    genome_config = config.genome_config
+    activation_names = data["activation_names"].tolist()
+    aggregation_names = data["aggregation_names"].tolist()
+    node_keys = data["node_keys"].tolist()
+    bias = data["bias"].tolist()
+    response = data["response"].tolist()
+    activation = data["activation"].tolist()
+    aggregation = data["aggregation"].tolist()
+    connection_arrays = [data[name] for name in ("connection_in", "connection_out", "weight", "enabled")]
+    connection_in, connection_out, weight, enabled = [array.tolist() for array in connection_arrays]
+
+    genomes = {}
+    node_start = connection_start = 0
+    for key, node_count, connection_count in zip(data["genome_keys"].tolist(), data["node_counts"].tolist(), data["connection_counts"].tolist()):
+        node_end = node_start + node_count
+        connection_end = connection_start + connection_count
+        if key in wanted:
+            genome = config.genome_type(key)
+            for i in range(node_start, node_end):
+                node = genome_config.node_gene_type(node_keys[i])
+                node.bias = bias[i]
+                node.response = response[i]
+                node.activation = activation_names[activation[i]]
+                node.aggregation = aggregation_names[aggregation[i]]
+                genome.nodes[node.key] = node
+            if hasattr(genome, "set_connections"):
+                genome.set_connections(*(array[connection_start:connection_end].copy() for array in connection_arrays))
+            else:
+                for i in range(connection_start, connection_end):
+                    connection = genome_config.connection_gene_type((connection_in[i], connection_out[i]))
+                    connection.weight = weight[i]
+                    connection.enabled = enabled[i]
+                    genome.connections[connection.key] = connection
+            genomes[key] = genome
+        node_start, connection_start = node_end, connection_end
+    return genomes
+
+
+class CompactCheckpointer(BaseReporter):
+
+    def __init__(self, generation_interval=1, directory="checkpoints", keep=5, resume=None):
+        self.generation_interval = generation_interval
+        self.directory = directory
+        self.keep = keep
+        # Genomes never change after they are created, so each is written once and found by key afterwards
+        self.segments = {}
+        self.manifests = []
+        self.writer = None
+        self.last_generation = None
+        # Extinct species leave the species set, the next key is tracked here so a resume never reuses one
+        self.next_species_key = 1
+
+        # A resumed run keeps the checkpoints up to the one it started from, a new run replaces the old ones
+        existing = CompactCheckpointer.generations(directory)
+        if resume is not None:
+            for generation in existing:
+                if generation <= resume:
+                    with open(self.manifest_path(generation)) as f:
+                        self.manifests.append(json.load(f))
+            self.segments = {int(key): segment for key, segment in self.manifests[-1]["genomes"].items()}
+            self.next_species_key = self.manifests[-1]["next_species_key"]
+        elif existing:
+            print(f"Starting a new run, the {len(existing)} checkpoints in {directory} are replaced")
+
+    def start_generation(self, generation):
+        self.current_generation = generation
+
+    def end_generation(self, config, population, species_set):
+        if self.last_generation is not None and self.current_generation - self.last_generation < self.generation_interval:
+            return
+        self.last_generation = self.current_generation
+        self.save(config, population, species_set, self.current_generation + 1)
+
+    def save(self, config, population, species_set, generation):
+        # The manifest is taken now, the genome arrays are packed and written in the background.
+        # One write at a time, so a slow disk delays the next checkpoint instead of training
+        self.wait()
+        self.next_species_key = max(self.next_species_key, max(species_set.species, default=0) + 1)
+        new = [genome for key, genome in population.items() if key not in self.segments]
+        segment = f"genomes-{generation:06d}.npz" if new else None
+        for genome in new:
+            self.segments[genome.key] = segment
+
+        manifest = {
+            "generation": generation,
+            "genomes": {str(key): self.segments[key] for key in population},
+            "fitness": {str(key): genome.fitness for key, genome in population.items()},
+            "species": [{
+                "key": s.key,
+                "created": s.created,
+                "last_improved": s.last_improved,
+                "representative": s.representative.key,
+                "members": list(s.members),
+                "fitness": s.fitness,
+                "adjusted_fitness": s.adjusted_fitness,
+                "fitness_history": list(s.fitness_history),
+            } for s in species_set.species.values()],
+            "next_species_key": self.next_species_key,
+            "next_node_key": max((key for genome in population.values() for key in genome.nodes), default=config.genome_config.num_outputs) + 1,
+            "random_state": random.getstate(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+        self.writer = threading.Thread(target=self.write, args=(manifest, segment, new), daemon=True)
+        self.writer.start()
+
+    def write(self, manifest, segment, genomes):
+        start = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        size = 0
+        if segment is not None:
+            path = os.path.join(self.directory, segment)
+            tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+            np.savez_compressed(tmp_path, **pack_genomes(genomes))
+            os.replace(tmp_path, path)
+            size += os.path.getsize(path)
+
+        # The manifest goes last, a checkpoint only exists once every segment it names is on disk
+        path = self.manifest_path(manifest["generation"])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+        size += os.path.getsize(path)
+        self.manifests.append(manifest)
+        self.prune()
+        print(f"Saved checkpoint {path} with {len(genomes)} new genomes, {size / 1e6:.1f} MB in {time.perf_counter() - start:.2f}s")
+
+    def prune(self):
+        # Old manifests and those of a replaced run go first, then every segment no kept manifest refers to
+        self.manifests = self.manifests[-self.keep:]
+        kept = {manifest["generation"] for manifest in self.manifests}
+        for generation in CompactCheckpointer.generations(self.directory):
+            if generation not in kept:
+                os.remove(self.manifest_path(generation))
+        used = {segment for manifest in self.manifests for segment in manifest["genomes"].values()}
+        for path in glob.glob(os.path.join(self.directory, "genomes-*.npz")):
+            if os.path.basename(path) not in used:
+                os.remove(path)
+        self.segments = {key: segment for key, segment in self.segments.items() if segment in used}
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+    def manifest_path(self, generation):
+        return os.path.join(self.directory, f"checkpoint-{generation:06d}.json")
+
+    @staticmethod
+    def generations(directory="checkpoints"):
+        if not os.path.isdir(directory):
+            return []
+        return sorted(int(m.group(1)) for m in map(MANIFEST_PATTERN.search, os.listdir(directory)) if m)
+
+    @staticmethod
+    def latest(directory="checkpoints"):
+        return max(CompactCheckpointer.generations(directory), default=None)
+
+    @staticmethod
+    def restore(config, directory="checkpoints", generation="latest"):
+        # Population of the given generation, or None when there is no checkpoint to resume from
+        if generation == "latest":
+            generation = CompactCheckpointer.latest(directory)
+            if generation is None:
+                return None
+        with open(os.path.join(directory, f"checkpoint-{generation:06d}.json")) as f:
+            manifest = json.load(f)
+
+        wanted = {}
+        for key, segment in manifest["genomes"].items():
+            wanted.setdefault(segment, set()).add(int(key))
+        population = {}
+        for segment, keys in wanted.items():
+            with np.load(os.path.join(directory, segment)) as data:
+                population.update(unpack_genomes(data, config, keys))
+        for key, fitness in manifest["fitness"].items():
+            population[int(key)].fitness = fitness
+
+        species_set = config.species_set_type(config.species_set_config, ReporterSet())
+        for entry in manifest["species"]:
+            s = Species(entry["key"], entry["created"])
+            s.last_improved = entry["last_improved"]
+            s.representative = population[entry["representative"]]
+            s.members = {key: population[key] for key in entry["members"]}
+            s.fitness = entry["fitness"]
+            s.adjusted_fitness = entry["adjusted_fitness"]
+            s.fitness_history = entry["fitness_history"]
+            species_set.species[s.key] = s
+            for key in s.members:
+                species_set.genome_to_species[key] = s.key
+        species_set.indexer = count(manifest["next_species_key"])
+
+        version, state, gauss = manifest["random_state"]
+        random.setstate((version, tuple(state), gauss))
+
+        p = neat.Population(config, (population, species_set, manifest["generation"]))
+        species_set.reporters = p.reporters
+        CompactCheckpointer.continue_indexers(p)
+        config.genome_config.node_indexer = count(manifest["next_node_key"])
+        return p
+
+    @staticmethod
+    def continue_indexers(p):
+        # A restored DefaultReproduction counts genome keys from 1 again, which would reuse keys of the population
+        p.reproduction.genome_indexer = count(max(p.population, default=0) + 1)
@@ -0,0 +1,27 @@
+from pyboy import PyBoy
+
+
+class EmulatorSettings:
+
+    def __init__(self, window="null", emulation_speed=0, sound_emulated=False, render="observed"):
+        self.window = window
+        # 0 runs unthrottled, otherwise a multiple of real time
+        self.emulation_speed = emulation_speed
+        self.sound_emulated = sound_emulated
+        # "observed" renders only the frames a genome sees, "always" renders every frame
+        self.render = render
+
+    @staticmethod
+    def training():
+        # Headless and as fast as the emulator can go, safe to run on a server without a display
+        return EmulatorSettings()
+
+    @staticmethod
+    def watch(emulation_speed=1):
+        # A real window at a watchable speed for looking at a single genome
+        return EmulatorSettings(window="SDL2", emulation_speed=emulation_speed, render="always")
+
+    def create_pyboy(self, game_path):
+        pyboy = PyBoy(game_path, window=self.window, sound_volume=0, sound_emulated=self.sound_emulated)
+        pyboy.set_emulation_speed(self.emulation_speed)
+        return pyboy
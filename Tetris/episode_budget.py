@@ -0,0 +1,44 @@
+from multiprocessing import Value
+import configparser
+import math
+import time
+
+
+class EpisodeBudget:
+
+    def __init__(self, max_steps=0, max_seconds=0.0, quorum=1.0):
+        # 0 leaves a limit off, quorum is the share of a generation that has to finish before the rest is cut off
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.quorum = quorum
+        # Set by the coordinator once the quorum is reached and read by every worker, a plain byte needs no lock
+        # The coordinator gives a skipped genome an inherited fitness, see ModelHandler.inherit
+        self.cutoff = Value("b", 0, lock=False)
+
+    @staticmethod
+    def from_config(config_file):
+        # None when the config has no [EpisodeBudget] section
+        parser = configparser.ConfigParser()
+        parser.read(config_file)
+        if not parser.has_section("EpisodeBudget"):
+            return None
+        section = parser["EpisodeBudget"]
+        return EpisodeBudget(section.getint("max_steps", fallback=0), section.getfloat("max_seconds", fallback=0.0), section.getfloat("quorum", fallback=1.0))
+
+    def exceeded(self, steps, started):
+        # Why an episode has to stop now, or None while it may go on
+        if self.max_steps and steps >= self.max_steps:
+            return "steps"
+        if self.max_seconds and time.perf_counter() - started >= self.max_seconds:
+            return "time"
+        if self.cutoff.value:
+            # Only episodes already running are cut off, one still queued is skipped and never played
+            return "quorum" if steps else "unplayed"
+        return None
+
+    def deterministic(self, truncated):
+        # Only the step limit ends an episode at the same point every time
+        return truncated is None or truncated == "steps"
+
+    def quorum_size(self, count):
+        return math.ceil(self.quorum * count) if self.quorum < 1.0 else count
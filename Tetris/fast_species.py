@@ -0,0 +1,217 @@
+from neat.species import DefaultSpeciesSet, Species
+from neat.math_util import mean, stdev
+import configparser
+import numpy as np
+
+# Connection keys (in, out) are packed into one uint64, node ids are shifted to stay positive
+KEY_OFFSET = 1 << 31
+
+# Below this many connections the per-call NumPy overhead costs more than the stock loop saves
+SMALL_GENOME = 256
+
+
+def pack_keys(sources, targets):
+    # Vectorized form of the packing below, shifted as uint64 so keys of output nodes do not overflow
+    return ((np.asarray(sources, dtype=np.int64) + KEY_OFFSET).astype(np.uint64) << np.uint64(32)) | (np.asarray(targets, dtype=np.int64) + KEY_OFFSET).astype(np.uint64)
+
+
+class GenomeArrays:
+
+    def __init__(self, genome, activations, aggregations):
+        # Genes are kept in dict order so sums run in the same order as DefaultGenome.distance
+        self.genome = genome
+
+        if hasattr(genome, "expressed_connections"):
+            # An ArrayGenome already holds its connections as arrays
+            self.connection_keys = pack_keys(genome.sources, genome.targets)
+            self.weights = genome.weights
+            self.enabled = genome.enabled
+        else:
+            connections = genome.connections
+            count = len(connections)
+            self.connection_keys = np.fromiter((((i + KEY_OFFSET) << 32) | (o + KEY_OFFSET) for i, o in connections), dtype=np.uint64, count=count)
+            self.weights = np.fromiter((c.weight for c in connections.values()), dtype=np.float64, count=count)
+            self.enabled = np.fromiter((c.enabled for c in connections.values()), dtype=bool, count=count)
+        self.connection_order = np.argsort(self.connection_keys)
+        self.connection_sorted = self.connection_keys[self.connection_order]
+
+        nodes = genome.nodes
+        count = len(nodes)
+        self.node_keys = np.fromiter(nodes, dtype=np.int64, count=count)
+        self.bias = np.fromiter((n.bias for n in nodes.values()), dtype=np.float64, count=count)
+        self.response = np.fromiter((n.response for n in nodes.values()), dtype=np.float64, count=count)
+        self.activation = np.fromiter((activations.setdefault(n.activation, len(activations)) for n in nodes.values()), dtype=np.int64, count=count)
+        self.aggregation = np.fromiter((aggregations.setdefault(n.aggregation, len(aggregations)) for n in nodes.values()), dtype=np.int64, count=count)
+        self.node_order = np.argsort(self.node_keys)
+        self.node_sorted = self.node_keys[self.node_order]
+
+    @staticmethod
+    def homologous(keys_sorted, order, other_sorted, other_order):
+        # Mask of the shared genes in dict order, and their positions in the other genome
+        if len(other_sorted) == 0:
+            return np.zeros(len(keys_sorted), dtype=bool), np.zeros(0, dtype=np.int64)
+
+        # Searching with sorted keys walks both arrays in order, much faster than random lookups
+        index = np.minimum(np.searchsorted(other_sorted, keys_sorted), len(other_sorted) - 1)
+        found = np.empty(len(keys_sorted), dtype=bool)
+        found[order] = other_sorted[index] == keys_sorted
+        position = np.empty(len(keys_sorted), dtype=np.int64)
+        position[order] = other_order[index]
+        return found, position[found]
+
+    def distance(self, other, config):
+        # Same arithmetic as DefaultGenome.distance, with self as the genome whose genes are summed
+        node_distance = 0.0
+        if len(self.node_keys) or len(other.node_keys):
+            found, match = GenomeArrays.homologous(self.node_sorted, self.node_order, other.node_sorted, other.node_order)
+            d = np.abs(self.bias[found] - other.bias[match]) + np.abs(self.response[found] - other.response[match])
+            d = d + (self.activation[found] != other.activation[match])
+            d = d + (self.aggregation[found] != other.aggregation[match])
+            shared = len(match)
+            if shared:
+                node_distance = float(np.cumsum(d * config.compatibility_weight_coefficient)[-1])
+            disjoint = len(self.node_keys) + len(other.node_keys) - 2 * shared
+            max_nodes = max(len(self.node_keys), len(other.node_keys))
+            node_distance = (node_distance + (config.compatibility_disjoint_coefficient * disjoint)) / max_nodes
+
+        connection_distance = 0.0
+        if len(self.connection_keys) or len(other.connection_keys):
+            found, match = GenomeArrays.homologous(self.connection_sorted, self.connection_order, other.connection_sorted, other.connection_order)
+            d = np.abs(self.weights[found] - other.weights[match])
+            d = d + (self.enabled[found] != other.enabled[match])
+            shared = len(match)
+            if shared:
+                connection_distance = float(np.cumsum(d * config.compatibility_weight_coefficient)[-1])
+            disjoint = len(self.connection_keys) + len(other.connection_keys) - 2 * shared
+            max_connections = max(len(self.connection_keys), len(other.connection_keys))
+            connection_distance = (connection_distance + (config.compatibility_disjoint_coefficient * disjoint)) / max_connections
+
+        return node_distance + connection_distance
+
+
+class FastSpeciesSet(DefaultSpeciesSet):
+
+    def __init__(self, config, reporters):
+        super().__init__(config, reporters)
+        self.clear_cache()
+
+    @staticmethod
+    def select(config_file):
+        # The species set is picked by the section name in the NEAT config file
+        parser = configparser.ConfigParser()
+        parser.read(config_file)
+        return FastSpeciesSet if parser.has_section("FastSpeciesSet") else DefaultSpeciesSet
+
+    def clear_cache(self):
+        # Genomes never change after they are created, so arrays and distances are kept by genome key
+        self.arrays = {}
+        self.distances = {}
+        self.activations = {}
+        self.aggregations = {}
+
+    def __getstate__(self):
+        # Checkpoints only need the species, the caches are rebuilt on demand
+        state = dict(self.__dict__)
+        for name in ("arrays", "distances", "activations", "aggregations"):
+            state[name] = {}
+        return state
+
+    def genome_arrays(self, genome):
+        arrays = self.arrays.get(genome.key)
+        if arrays is not None and arrays.genome is genome:
+            return arrays
+
+        # A different genome object under a known key, e.g. after a restore, invalidates its distances
+        if arrays is not None:
+            self.distances = {pair: d for pair, d in self.distances.items() if genome.key not in pair}
+        arrays = GenomeArrays(genome, self.activations, self.aggregations)
+        self.arrays[genome.key] = arrays
+        return arrays
+
+    def distance(self, genome0, genome1, config, used):
+        # used mirrors GenomeDistanceCache within one generation, so either order hits
+        pair = (genome0.key, genome1.key)
+        d = used.get(pair)
+        if d is not None:
+            return d
+
+        # Across generations only the same order is reused, a reversed sum can differ in the last bit
+        d = self.distances.get(pair)
+        if d is None:
+            if len(genome0.connections) < SMALL_GENOME and len(genome1.connections) < SMALL_GENOME:
+                d = genome0.distance(genome1, config)
+            else:
+                d = self.genome_arrays(genome0).distance(self.genome_arrays(genome1), config)
+            self.distances[pair] = d
+        used[pair] = d
+        used[genome1.key, genome0.key] = d
+        return d
+
+    def speciate(self, config, population, generation):
+        # DefaultSpeciesSet.speciate with the distance cache kept between generations
+        assert isinstance(population, dict)
+
+        compatibility_threshold = self.species_set_config.compatibility_threshold
+        genome_config = config.genome_config
+
+        unspeciated = set(population.keys())
+        used = {}
+        new_representatives = {}
+        new_members = {}
+        for sid, s in self.species.items():
+            candidates = []
+            for gid in unspeciated:
+                g = population[gid]
+                d = self.distance(s.representative, g, genome_config, used)
+                candidates.append((d, g))
+
+            # The new representative is the genome closest to the current representative.
+            ignored_rdist, new_rep = min(candidates, key=lambda x: x[0])
+            new_rid = new_rep.key
+            new_representatives[sid] = new_rid
+            new_members[sid] = [new_rid]
+            unspeciated.remove(new_rid)
+
+        while unspeciated:
+            gid = unspeciated.pop()
+            g = population[gid]
+
+            # Find the species with the most similar representative.
+            candidates = []
+            for sid, rid in new_representatives.items():
+                rep = population[rid]
+                d = self.distance(rep, g, genome_config, used)
+                if d < compatibility_threshold:
+                    candidates.append((d, sid))
+
+            if candidates:
+                ignored_sdist, sid = min(candidates, key=lambda x: x[0])
+                new_members[sid].append(gid)
+            else:
+                sid = next(self.indexer)
+                new_representatives[sid] = gid
+                new_members[sid] = [gid]
+
+        self.genome_to_species = {}
+        for sid, rid in new_representatives.items():
+            s = self.species.get(sid)
+            if s is None:
+                s = Species(sid, generation)
+                self.species[sid] = s
+
+            members = new_members[sid]
+            for gid in members:
+                self.genome_to_species[gid] = sid
+
+            member_dict = dict((gid, population[gid]) for gid in members)
+            s.update(population[rid], member_dict)
+
+        # Only genomes that can still be compared next generation stay cached
+        keep = set(population)
+        self.arrays = {key: arrays for key, arrays in self.arrays.items() if key in keep}
+        self.distances = {pair: d for pair, d in self.distances.items() if pair[0] in keep and pair[1] in keep}
+
+        gdmean = mean(used.values())
+        gdstdev = stdev(used.values())
+        self.reporters.info(
+            'Mean genetic distance {0:.3f}, standard deviation {1:.3f}'.format(gdmean, gdstdev))
@@ -0,0 +1,54 @@
+class FrameSkip:
+
+    def __init__(self, pyboy, frames_per_action, watch_addresses=(), check_every=1, render_every_frame=False):
+        self.pyboy = pyboy
+        self.frames_per_action = frames_per_action
+        self.watch_addresses = list(watch_addresses)
+        self.watch_values = [0] * len(self.watch_addresses)
+        self.check_every = check_every if self.watch_addresses else frames_per_action
+        self.render_every_frame = render_every_frame
+        self.running = True
+        # Set by the emulator handler when steps are being profiled
+        self.profiler = None
+
+    def advance(self):
+        # Run the repeated frames without rendering and render only the frame that gets observed
+        remaining = self.frames_per_action - 1
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.mark("act")
+
+        memory = self.pyboy.memory
+        for i, address in enumerate(self.watch_addresses):
+            self.watch_values[i] = memory[address]
+
+        while remaining > 0 and self.running:
+            frames = min(self.check_every, remaining)
+            self.running = self.tick(frames, False)
+            remaining -= frames
+            if self.watch_changed():
+                break
+
+        if self.running:
+            self.running = self.tick(1, True)
+        if profiler is not None:
+            profiler.mark("emulation")
+        return self.running
+
+    def tick(self, frames, render):
+        if not self.render_every_frame:
+            return self.pyboy.tick(frames, render)
+
+        # Someone is watching, show every frame
+        for _ in range(frames):
+            if not self.pyboy.tick(1, True):
+                return False
+        return True
+
+    def watch_changed(self):
+        # Stop skipping as soon as a watched address changes, e.g. a new piece or a battle starting
+        memory = self.pyboy.memory
+        for i, address in enumerate(self.watch_addresses):
+            if memory[address] != self.watch_values[i]:
+                return True
+        return False
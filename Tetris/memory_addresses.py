@@ -4,3 +4,11 @@ GAME_STATE = 0xFFE1 # 0 = in game, 4 = game over
 PIECE_CHANGE = 0xFF86
 CURRENT_PIECE_X = 0xFF88
 CURRENT_PIECE_Y = 0xFF87
+
+CURRENT_PIECE = 0xC203 # piece id << 2 | rotation
+NEXT_PIECE = 0xC213
+PLAYFIELD_TILEMAP = 0x9802 # background map column 2, the playfield is 10 columns by 18 rows
+PLAYFIELD_ROWS, PLAYFIELD_COLS = 18, 10
+BLANK_TILE = 47
+LINES_TILEMAP = 0x994E # background map row 10, column 14, the lines counter as 4 digit tiles
+LINES_DIGITS = 4
@@ -0,0 +1,66 @@
+from scipy.spatial import cKDTree
+import configparser
+import numpy as np
+import os
+
+
+class NoveltyArchive:
+
+    def __init__(self, k=15, weight=1.0, add_per_generation=5):
+        # Novelty of an episode is its mean distance to the k nearest behaviours in the archive and in its own generation
+        self.k = k
+        # Selection sees fitness + weight * novelty
+        self.weight = weight
+        # The most novel behaviours of every generation join the archive
+        self.add_per_generation = add_per_generation
+        self.behaviours = np.zeros((0, 0))
+        # Generation every behaviour was archived in, so a resumed run drops what came after its checkpoint
+        self.generations = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.behaviours)
+
+    @staticmethod
+    def from_config(config_file):
+        # None when the config has no [NoveltyArchive] section or turns it off with weight = 0
+        parser = configparser.ConfigParser()
+        parser.read(config_file)
+        if not parser.has_section("NoveltyArchive"):
+            return None
+        section = parser["NoveltyArchive"]
+        archive = NoveltyArchive(section.getint("k", fallback=15), section.getfloat("weight", fallback=1.0), section.getint("add_per_generation", fallback=5))
+        return archive if archive.weight != 0 else None
+
+    def scores(self, behaviours):
+        # One row per episode. Counters and coordinates have different ranges, so every dimension is scaled by its spread
+        points = np.concatenate([self.behaviours, behaviours]) if len(self.behaviours) else behaviours
+        scale = points.std(axis=0)
+        scale[scale == 0] = 1.0
+        k = min(self.k + 1, len(points))
+        if k < 2:
+            return np.zeros(len(behaviours))
+        distances, _ = cKDTree(points / scale).query(behaviours / scale, k=k)
+        # The nearest point of every episode is the episode itself
+        return distances[:, 1:].mean(axis=1)
+
+    def add(self, behaviours, novelty, generation):
+        chosen = np.argsort(-novelty, kind="stable")[:self.add_per_generation]
+        self.behaviours = np.concatenate([self.behaviours, behaviours[chosen]]) if len(self.behaviours) else behaviours[chosen]
+        self.generations = np.concatenate([self.generations, np.full(len(chosen), generation, dtype=np.int64)])
+        return len(chosen)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, behaviours=self.behaviours, generations=self.generations)
+        os.replace(tmp_path, path)
+
+    def load(self, path, generation):
+        # Keep what was archived before the given generation, the number of behaviours kept
+        if not os.path.exists(path):
+            return 0
+        with np.load(path) as data:
+            kept = data["generations"] < generation
+            self.behaviours = data["behaviours"][kept]
+            self.generations = data["generations"][kept]
+        return len(self.behaviours)
@@ -1,101 +1,185 @@
 import random
 from pyboy import PyBoy
 from memory_addresses import *
-from skimage.transform import downscale_local_mean
+from observation_buffer import ObservationBuffer
+from action_trace import ActionTrace
+from ram_snapshot import RamSchema, Byte, Tiles
+from board_features import BoardFeatures
 import numpy as np
 
+# Everything read from RAM each step, fetched in one pass into a single buffer
+STATE_SCHEMA = RamSchema(
+    score=Byte(SCORE),
+    level=Byte(LEVEL),
+    game_state=Byte(GAME_STATE),
+    piece_change=Byte(PIECE_CHANGE),
+    piece_x=Byte(CURRENT_PIECE_X),
+    piece_y=Byte(CURRENT_PIECE_Y),
+)
+
+# The features observation also reads the playfield tile map and the piece ids
+FEATURE_SCHEMA = RamSchema(
+    board=Tiles(PLAYFIELD_TILEMAP, PLAYFIELD_ROWS, PLAYFIELD_COLS),
+    piece=Byte(CURRENT_PIECE),
+    next_piece=Byte(NEXT_PIECE),
+    **STATE_SCHEMA.fields,
+)
+
+# What the stuck detector hashes after every decision, the playfield and the falling piece
+STUCK_SCHEMA = RamSchema(
+    board=Tiles(PLAYFIELD_TILEMAP, PLAYFIELD_ROWS, PLAYFIELD_COLS),
+    piece=Byte(CURRENT_PIECE),
+    piece_x=Byte(CURRENT_PIECE_X),
+    piece_y=Byte(CURRENT_PIECE_Y),
+    game_state=Byte(GAME_STATE),
+)
+
+MAX_RECENT_ACTIONS = 5
+SCALE_FACTOR = 4
+OBSERVATION_SIZES = {
+    "pixels": MAX_RECENT_ACTIONS + 2 + (144 // SCALE_FACTOR) * (160 // SCALE_FACTOR) * 3,
+    "features": MAX_RECENT_ACTIONS + 2 + BoardFeatures.SIZE,
+}
+
 class Player:
     
-    def __init__(self, pyboy: PyBoy, net, genome):
+    def __init__(self, pyboy: PyBoy, net, genome, frame_skip, observation_mode="pixels", seed=None, stuck=None):
         self.pyboy = pyboy
+        self.frame_skip = frame_skip
         self.net = net
         self.genome = genome
         self.actions = ['','a', 'b', 'left', 'right', 'up', 'down']
         self.rewards = {'score': 100, 'level': 1000, 'new_piece': 1, 'game_over': -10}
-        self.wait_for_action = 1
-        self.max_recent_actions = 5
-        self.recent_actions = [random.randint(0, 8) for _ in range(self.max_recent_actions)]
-        self.recent_screens = np.zeros((36, 40, 3), dtype=np.uint8)
-        self.all_actions = []
+        self.max_recent_actions = MAX_RECENT_ACTIONS
+        # A fixed seed makes every episode start from the same history, so a genome's fitness is reproducible
+        rng = random.Random(seed) if seed is not None else random
+        self.recent_actions = [rng.randint(0, 8) for _ in range(self.max_recent_actions)]
+        self.observation_mode = observation_mode
+        if observation_mode == "features":
+            # Recent actions, piece position, then board features instead of screens
+            self.observation = ObservationBuffer(self.max_recent_actions + 2 + BoardFeatures.SIZE, 0, self.recent_actions, stack_size=0, scale_factor=SCALE_FACTOR)
+            self.board_features = BoardFeatures(self.observation.scalars[self.max_recent_actions + 2:])
+        else:
+            # Recent actions, piece position, then 3 stacked 36x40 screens
+            self.observation = ObservationBuffer(self.max_recent_actions + 2, 0, self.recent_actions, stack_size=3, scale_factor=SCALE_FACTOR)
+        self.trace = ActionTrace()
         self.last_score = 0
         self.last_level = 0
+        # How often each reward was given this episode, reported with the episode stats instead of printed
+        self.reward_counts = dict.fromkeys(self.rewards, 0)
+        self.ram = (FEATURE_SCHEMA if observation_mode == "features" else STATE_SCHEMA).snapshot(pyboy)
+        self.ram_stale = True
+        # Optional StuckDetector of the emulator handler, reset by it between episodes
+        self.stuck = stuck
+        self.stuck_ram = STUCK_SCHEMA.snapshot(pyboy) if stuck is not None else None
     
     def reward_function(self, state):
         final_reward = 0
         
         # Reward for score
         if state["score"] > self.last_score:
-            print("Score increased")
+            self.reward_counts["score"] += 1
             final_reward += self.rewards["score"]
             self.last_score = state["score"]
         
         # Reward for level
         if state["level"] > self.last_level:
-            print("Level increased")
+            self.reward_counts["level"] += 1
             final_reward += self.rewards["level"]
             self.last_level = state["level"]
         
         # Reward for new piece
         if state["piece_change"] == 128:
+            self.reward_counts["new_piece"] += 1
             final_reward += self.rewards["new_piece"]
         
         return final_reward
             
     def step(self):
+        observation = self.begin_step()
+        return self.end_step(self.net.activate(observation))
+    
+    def begin_step(self):
+        return self.get_observation()
+    
+    def end_step(self, result):
         
-        self.perform_action()
+        self.perform_action(result)
         state = self.get_state()
         reward = self.reward_function(state)
         
         # Check if game is over
-        if self.pyboy.memory[GAME_STATE] != 0:
+        if self.ram["game_state"] != 0:
+            self.reward_counts["game_over"] += 1
             reward += self.rewards["game_over"]
             return True, reward
+
+        # A stalled game keeps the same board and piece until max_steps runs out
+        if self.stuck is not None and self.stuck.update(self.stuck_ram.read().data):
+            reward += self.stuck.penalty
+            return self.stuck.terminate, reward
         
         return False, reward
     
+    def behaviour(self):
+        # Lines cleared, level, pieces placed and height of the final stack, read once when the episode ends
+        memory = self.pyboy.memory
+        digits = [memory[address] for address in range(LINES_TILEMAP, LINES_TILEMAP + LINES_DIGITS) if memory[address] < 10]
+        lines = int("".join(map(str, digits))) if digits else 0
+        filled_rows = np.flatnonzero(self.get_board().any(axis=1))
+        height = PLAYFIELD_ROWS - int(filled_rows[0]) if len(filled_rows) else 0
+        return [lines, memory[LEVEL], self.reward_counts["new_piece"], height]
+
     def get_state(self):
-        return {"score": self.pyboy.memory[SCORE], "level": self.pyboy.memory[LEVEL], "piece_change": self.pyboy.memory[PIECE_CHANGE]}
+        self.read_ram()
+        return {"score": self.ram["score"], "level": self.ram["level"], "piece_change": self.ram["piece_change"]}
+
+    def read_ram(self):
+        # RAM only changes when the emulator runs, so one read per action is enough
+        if self.ram_stale:
+            self.ram.read()
+            self.ram_stale = False
     
-    def perform_action(self):
-        action = self.get_action()
+    def perform_action(self, result):
+        action = self.get_action(result)
 
         if action != '':
             self.pyboy.button(action)
-        self.pyboy.tick(self.wait_for_action)
+        self.frame_skip.advance()
+        self.ram_stale = True
     
-    def get_action(self):
-        
-        # Add observation to input
-        observation = self.get_observation()
+    def get_action(self, result):
         
-        result = self.net.activate(observation)
-        
-        action_index = result.index(max(result))
-        self.recent_actions.append(action_index)
-        self.all_actions.append(self.actions[action_index])
-
-        if len(self.recent_actions) > self.max_recent_actions:
-            self.recent_actions.pop(0)
+        action_index = int(np.argmax(result))
+        self.observation.push_action(action_index)
+        self.trace.append(action_index)
             
         return self.actions[action_index]
     
     def get_observation(self):
         
-        screen = self.render()
-        self.update_recent_screens(screen)
-        
-        # Flatten and normalize the screen data
-        flattened_screens = self.recent_screens.flatten() / 255.0
-        
-        # Combine recent actions and flattened screen data
-        observation = self.recent_actions + self.get_piece_position() + flattened_screens.tolist()
+        # Write the piece position and the newest screen straight into the observation buffer
+        self.read_ram()
+        scalars = self.observation.scalars
+        scalars[self.max_recent_actions] = self.ram["piece_x"]
+        scalars[self.max_recent_actions + 1] = self.ram["piece_y"]
+        if self.observation_mode == "features":
+            self.board_features.update(self.ram["board"], self.ram["piece"], self.ram["next_piece"])
+        else:
+            self.observation.push_screen(self.get_screen())
         
-        return observation
-    
-    def update_recent_screens(self, cur_screen):
-        self.recent_screens = np.roll(self.recent_screens, 1, axis=2)
-        self.recent_screens[:, :, 0] = cur_screen[:,:, 0]
+        return self.observation.vector
+
+    @staticmethod
+    def observation_mode_for(num_inputs):
+        # The observation is picked by the network size in the NEAT config
+        for mode, size in OBSERVATION_SIZES.items():
+            if size == num_inputs:
+                return mode
+        raise ValueError(f"num_inputs must be one of {OBSERVATION_SIZES}, got {num_inputs}")
+
+    def get_screen(self):
+        return self.pyboy.screen.ndarray
     
     def manual_inputs(self):
         command = input("Enter command (one of: a, b, left, right, up, down, start, select): ")
@@ -105,27 +189,19 @@ class Player:
         else:
             print("Invalid input")
             
-    def save_actions(self, final_reward):
+    def save_actions(self, final_reward, header):
         if final_reward > 1:
-            with open(f"checkpoints/{self.genome.key}_actions.txt", "w") as f:
-                for action in self.all_actions:
-                    f.write(action + "\n")
-    
-    def render(self, reduce_res=True, scale_factor=4):
-        game_pixels_render = self.pyboy.screen.ndarray[:,:,0:1]
-        if reduce_res:
-            game_pixels_render = (
-                downscale_local_mean(game_pixels_render, (scale_factor, scale_factor, 1))
-            ).astype(np.uint8)
-        return game_pixels_render
+            self.trace.header = dict(header, genome_key=self.genome.key, fitness=final_reward, actions=self.actions)
+            self.trace.save(f"checkpoints/{self.genome.key}_actions.trace")
     
     def get_map_positions(self):
-        map_positions = []
-        for i in range(160):
-            for j in range(144):
-                if self.pyboy.screen.ndarray[i,j,0] == 0:
-                    map_positions.append((i,j))
-        return map_positions
+        # (x, y) of every black pixel, the screen array is indexed [y, x]
+        return [(x, y) for y, x in np.argwhere(self.pyboy.screen.ndarray[:, :, 0] == 0).tolist()]
+
+    def get_board(self):
+        # 18x10 occupancy grid of the settled blocks
+        return BoardFeatures.occupancy(FEATURE_SCHEMA.snapshot(self.pyboy).read()["board"])
     
     def get_piece_position(self):
-        return [self.pyboy.memory[CURRENT_PIECE_X], self.pyboy.memory[CURRENT_PIECE_Y]]
+        self.read_ram()
+        return [self.ram["piece_x"], self.ram["piece_y"]]
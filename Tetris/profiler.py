@@ -0,0 +1,82 @@
+import numpy as np
+import time
+
+# Step latency histogram edges, 20 bins per decade from 1 us to 10 s
+LATENCY_BINS = np.geomspace(1e-6, 10, 141)
+
+
+class StepProfiler:
+
+    def __init__(self, sample_every=100):
+        self.sample_every = sample_every
+        self.step = 0
+        self.sampling = False
+        self.started = 0.0
+        self.last = 0.0
+        self.clear()
+
+    def clear(self):
+        self.samples = 0
+        self.latency = 0.0
+        self.histogram = np.zeros(len(LATENCY_BINS) + 1, dtype=np.int64)
+        self.stages = {}
+
+    def begin(self):
+        # Only every sample_every-th step is timed, the others cost one counter increment
+        self.step += 1
+        self.sampling = self.step % self.sample_every == 0
+        if self.sampling:
+            self.started = self.last = time.perf_counter()
+
+    def mark(self, stage, seconds=None):
+        # Time since the previous mark, or an explicit share of a stage run for several emulators at once
+        if self.sampling:
+            now = time.perf_counter()
+            self.stages[stage] = self.stages.get(stage, 0.0) + (now - self.last if seconds is None else seconds)
+            self.last = now
+
+    def end(self):
+        if self.sampling:
+            latency = time.perf_counter() - self.started
+            self.samples += 1
+            self.latency += latency
+            self.histogram[np.searchsorted(LATENCY_BINS, latency)] += 1
+            self.sampling = False
+
+    def report(self):
+        # Aggregates of one episode, small enough to send back with the fitness
+        report = {"steps": self.step, "samples": self.samples, "latency": self.latency, "histogram": self.histogram, "stages": self.stages}
+        self.step = 0
+        self.clear()
+        return report
+
+    @staticmethod
+    def percentile(histogram, q):
+        total = histogram.sum()
+        if total == 0:
+            return 0.0
+        index = int(np.searchsorted(np.cumsum(histogram), q * total))
+        return float(LATENCY_BINS[min(index, len(LATENCY_BINS) - 1)])
+
+    @staticmethod
+    def merge(reports, slowest=3):
+        # reports maps genome key to the report of its episode
+        histogram = np.zeros(len(LATENCY_BINS) + 1, dtype=np.int64)
+        stages = {}
+        means = []
+        for genome_key, report in reports.items():
+            histogram += report["histogram"]
+            for stage, seconds in report["stages"].items():
+                stages[stage] = stages.get(stage, 0.0) + seconds
+            if report["samples"]:
+                means.append((report["latency"] / report["samples"], genome_key))
+
+        staged = sum(stages.values())
+        return {
+            "samples": int(histogram.sum()),
+            "p50": StepProfiler.percentile(histogram, 0.5),
+            "p99": StepProfiler.percentile(histogram, 0.99),
+            "stages": stages,
+            "emulation_share": stages.get("emulation", 0.0) / staged if staged else 0.0,
+            "slowest": [(genome_key, seconds) for seconds, genome_key in sorted(means, reverse=True)[:slowest]],
+        }
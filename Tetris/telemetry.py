@@ -0,0 +1,141 @@
+from neat.reporting import BaseReporter
+import numpy as np
+import json
+import os
+import time
+
+
+class TelemetryReporter(BaseReporter):
+
+    def __init__(self, directory="telemetry", job="neat"):
+        # One JSON line per generation, and a Prometheus textfile collector file with the latest values
+        self.directory = directory
+        self.job = job
+        self.jsonl_path = os.path.join(directory, f"{job}.jsonl")
+        self.prometheus_path = os.path.join(directory, f"{job}.prom")
+        self.generation = 0
+        self.generation_start = 0.0
+        self.evaluation = {}
+        # Rewards given over the whole run, exported as counters
+        self.reward_totals = {}
+        self.episodes_total = 0
+        self.stuck_total = 0
+        self.frames_total = 0
+
+    def start_generation(self, generation):
+        self.generation = generation
+        self.generation_start = time.perf_counter()
+        self.evaluation = {}
+
+    def record_evaluation(self, stats, seconds, reused=0):
+        # Called by eval_genomes with the stats of every episode it played
+        workers = {}
+        truncated = {}
+        stuck = 0
+        rewards = {}
+        for episode in stats.values():
+            worker = workers.setdefault(episode["worker"], {"episodes": 0, "frames": 0, "start": float("inf"), "end": 0.0, "peak_rss": 0})
+            worker["episodes"] += 1
+            worker["frames"] += episode["frames"]
+            worker["start"] = min(worker["start"], episode["finished"] - episode["seconds"])
+            worker["end"] = max(worker["end"], episode["finished"])
+            worker["peak_rss"] = max(worker["peak_rss"], episode["peak_rss"])
+            if episode.get("truncated") is not None:
+                truncated[episode["truncated"]] = truncated.get(episode["truncated"], 0) + 1
+            if episode.get("stuck"):
+                stuck += 1
+            for reward, count in episode["rewards"].items():
+                rewards[reward] = rewards.get(reward, 0) + count
+
+        # Frames per second of a worker over the span it was busy, batched episodes overlap in that span
+        for worker in workers.values():
+            span = worker.pop("end") - worker.pop("start")
+            worker["frames_per_second"] = worker["frames"] / span if span > 0 else 0.0
+
+        frames = sum(worker["frames"] for worker in workers.values())
+        for reward, count in rewards.items():
+            self.reward_totals[reward] = self.reward_totals.get(reward, 0) + count
+        self.episodes_total += len(stats)
+        self.stuck_total += stuck
+        self.frames_total += frames
+        self.evaluation = {
+            "seconds": seconds,
+            "episodes": len(stats),
+            "reused": reused,
+            "frames": frames,
+            "frames_per_second": frames / seconds if seconds > 0 else 0.0,
+            "truncated": truncated,
+            "stuck": stuck,
+            "rewards": rewards,
+            "workers": workers,
+        }
+
+    def post_evaluate(self, config, population, species, best_genome):
+        fitnesses = np.array([genome.fitness for genome in population.values()], dtype=np.float64)
+        nodes = np.array([len(genome.nodes) for genome in population.values()])
+        connections = np.array([genome.size()[1] for genome in population.values()])
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "generation": self.generation,
+            "generation_seconds": time.perf_counter() - self.generation_start,
+            "fitness": {
+                "min": float(fitnesses.min()),
+                "p10": float(np.percentile(fitnesses, 10)),
+                "median": float(np.median(fitnesses)),
+                "p90": float(np.percentile(fitnesses, 90)),
+                "max": float(fitnesses.max()),
+                "mean": float(fitnesses.mean()),
+                "stdev": float(fitnesses.std()),
+                "best_genome": best_genome.key,
+            },
+            "species": {
+                "count": len(species.species),
+                "sizes": {str(sid): len(s.members) for sid, s in species.species.items()},
+            },
+            "genome_size": {
+                "nodes_mean": float(nodes.mean()),
+                "nodes_max": int(nodes.max()),
+                "connections_mean": float(connections.mean()),
+                "connections_max": int(connections.max()),
+            },
+            "evaluation": self.evaluation,
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.jsonl_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.write_prometheus(record)
+
+    def write_prometheus(self, record):
+        job = f'job="{self.job}"'
+        evaluation = record["evaluation"]
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP neat_{name} {help_text}")
+            lines.append(f"# TYPE neat_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"neat_{name}{{{','.join([job] + labels)}}} {value}")
+
+        metric("generation", "gauge", "Last evaluated generation.", [([], record["generation"])])
+        metric("fitness", "gauge", "Fitness distribution of the last generation.", [([f'stat="{stat}"'], value) for stat, value in record["fitness"].items() if stat != "best_genome"])
+        metric("species", "gauge", "Number of species.", [([], record["species"]["count"])])
+        metric("genome_size", "gauge", "Nodes and enabled connections per genome.", [([f'stat="{stat}"'], value) for stat, value in record["genome_size"].items()])
+        metric("generation_seconds", "gauge", "Wall clock of the last generation.", [([], record["generation_seconds"])])
+        if evaluation:
+            metric("evaluation_seconds", "gauge", "Wall clock of the last evaluation.", [([], evaluation["seconds"])])
+            metric("frames_per_second", "gauge", "Emulated frames per second over all workers.", [([], evaluation["frames_per_second"])])
+            metric("worker_frames_per_second", "gauge", "Emulated frames per second of every worker.", [([f'worker="{worker}"'], stats["frames_per_second"]) for worker, stats in evaluation["workers"].items()])
+            metric("worker_peak_rss_bytes", "gauge", "Peak resident memory of every worker.", [([f'worker="{worker}"'], stats["peak_rss"]) for worker, stats in evaluation["workers"].items()])
+            metric("stuck_episodes", "gauge", "Episodes of the last generation caught repeating the same state.", [([], evaluation["stuck"])])
+            metric("truncated_episodes", "gauge", "Episodes of the last generation cut off by a budget.", [([f'limit="{limit}"'], count) for limit, count in evaluation["truncated"].items()])
+        metric("episodes_total", "counter", "Episodes played since the run started.", [([], self.episodes_total)])
+        metric("stuck_episodes_total", "counter", "Episodes caught repeating the same state since the run started.", [([], self.stuck_total)])
+        metric("frames_total", "counter", "Frames emulated since the run started.", [([], self.frames_total)])
+        metric("rewards_total", "counter", "Rewards given since the run started.", [([f'reward="{reward}"'], count) for reward, count in self.reward_totals.items()])
+
+        # The collector may read at any moment, so the file is replaced in one step
+        tmp_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prometheus_path)